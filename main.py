@@ -4,13 +4,13 @@ import os
 import sys
 import time
 from datetime import timedelta
-import random  # Added by dalgu90
 
-from mimic.corenlp import segment_and_tokenize
-from mimic.extract import extract_mimic_documents
+from mimic.corenlp import DEFAULT_RETRY_POLICY, RetryPolicy, load_url_list, segment_and_tokenize
+from mimic.extract import build_document_filter, extract_mimic_documents, load_id_list
+from mimic.tokenizer import BACKENDS, compare_tokenizations
 from mimic.tools import ensure_dir
 from mimic.transform import replace_placeholders
-from mimic.w2v import build_model
+from mimic.w2v import build_model, prepare_corpus
 
 if __name__ == "__main__":
 
@@ -23,26 +23,148 @@ if __name__ == "__main__":
     parser_extract = subparsers.add_parser('EXTRACT', help="Extract MIMIC documents from database")
     parser_extract.add_argument("--url", help="Database URL", dest="url", type=str, required=True)
     parser_extract.add_argument("--output-dir", help="Output directory", dest="output_dir", type=str, required=True)
+    parser_extract.add_argument("--batch-size", help="Number of documents fetched at once (default: 1000)",
+                                dest="batch_size", type=int, default=1000)
+    parser_extract.add_argument("--n-writers", help="Number of writer threads (default: 4)", dest="n_writers", type=int,
+                                default=4)
+    parser_extract.add_argument("-n", "--n-jobs", help="Number of ranges of documents extracted concurrently "
+                                                       "(default: 1)", dest="n_jobs", type=int, default=1)
+    parser_extract.add_argument("--range-size", help="Maximum number of documents per range (default: 50000)",
+                                dest="range_size", type=int, default=50000)
+    parser_extract.add_argument("--output-format", help="One file per document or packed JSONL shards of 1000 "
+                                                        "documents (default: files)", dest="output_format", type=str,
+                                choices=["files", "jsonl"], default="files")
+    parser_extract.add_argument("--incremental", help="Only extract the documents added since the previous extraction "
+                                                      "into the output directory", action="store_true",
+                                dest="incremental")
+    parser_extract.add_argument("--detect-changes", help="With --incremental, also rewrite the documents whose content "
+                                                         "changed", action="store_true", dest="detect_changes")
+    parser_extract.add_argument("--categories", help="Categories to extract (e.g. \"Discharge summary\" or "
+                                                     "Discharge_summary)", dest="categories", type=str, nargs="+",
+                                default=None)
+    parser_extract.add_argument("--chartdate-from", help="First chart date (YYYY-MM-DD, included)",
+                                dest="chartdate_from", type=str, default=None)
+    parser_extract.add_argument("--chartdate-to", help="Last chart date (YYYY-MM-DD, included)", dest="chartdate_to",
+                                type=str, default=None)
+    parser_extract.add_argument("--hadm-ids", help="File with the hospital admission ids to extract (one per line)",
+                                dest="hadm_ids", type=str, default=None)
+    parser_extract.add_argument("--subject-ids", help="File with the subject ids to extract (one per line)",
+                                dest="subject_ids", type=str, default=None)
+    parser_extract.add_argument("--sample-ratio", help="Ratio of subjects to extract, chosen with a hash of their id",
+                                dest="sample_ratio", type=float, default=None)
+    parser_extract.add_argument("--sample-seed", help="Seed of the subject sampling (default: 0)", dest="sample_seed",
+                                type=int, default=0)
+    parser_extract.add_argument("--exclude-errors", help="Exclude the documents flagged as errors (iserror)",
+                                action="store_true", dest="exclude_errors")
 
     # MIMIC placeholders replacement
     parser_replace = subparsers.add_parser('REPLACE', help="Perform pseudonymization of the documents")
     parser_replace.add_argument("--input-dir", help="Input directory", dest="input_dir", type=str, required=True)
     parser_replace.add_argument("--output-dir", help="Output directory", dest="output_dir", type=str, required=True)
     parser_replace.add_argument("--list-dir", help="List directory", dest="list_dir", type=str, required=True)
-    parser_replace.add_argument("--seed", help="Python random seed", dest="seed", type=int, required=False, default=777)  # Added by dalgu90
+    # Added by dalgu90
+    parser_replace.add_argument("--seed", help="Python random seed", dest="seed", type=int, required=False,
+                                default=777)
+    parser_replace.add_argument("-n", "--n-jobs", help="Number of processes (default: 1)", dest="n_jobs", type=int,
+                                default=1)
+    parser_replace.add_argument("--list-store", help="Binary list store, built from --list-dir when missing or "
+                                                     "outdated (default: LIST_DIR/.lists.bin)", dest="list_store",
+                                type=str, default=None)
+    parser_replace.add_argument("--weighted-names", help="Sample census names according to their frequency",
+                                action="store_true", dest="weighted_names")
+    parser_replace.add_argument("--mapping-scope", help="Scope in which a placeholder with an identifier keeps the "
+                                                        "same replacement (default: global)", dest="mapping_scope",
+                                type=str, choices=["global", "category", "subject", "document"], default="global")
+    parser_replace.add_argument("--mapping-size", help="Maximum number of replacements cached by each process "
+                                                       "(default: 100000)", dest="mapping_size", type=int,
+                                default=100000)
+    parser_replace.add_argument("--subject-map", help="CSV file with row_id,subject_id lines (subject scope)",
+                                dest="subject_map", type=str, default=None)
+    parser_replace.add_argument("--mapping-store", help="SQLite file where replacements are persisted",
+                                dest="mapping_store", type=str, default=None)
+    parser_replace.add_argument("--resume", help="Resume an interrupted run, skipping files already processed",
+                                action="store_true", dest="resume")
+    parser_replace.add_argument("--delta", help="Only process the files of a delta list written by an incremental "
+                                                "extraction", dest="delta", type=str, default=None)
 
     # MIMIC document CoreNLP processing
     parser_corenlp = subparsers.add_parser('CORENLP', help="Process MIMIC documents with CoreNLP")
     parser_corenlp.add_argument("--input-dir", help="Input directory", dest="input_dir", type=str, required=True)
     parser_corenlp.add_argument("--output-dir", help="Output directory", dest="output_dir", type=str, required=True)
-    parser_corenlp.add_argument("--url", help="corenlp URL", dest="url", type=str, required=True)
+    parser_corenlp_urls = parser_corenlp.add_mutually_exclusive_group()
+    parser_corenlp_urls.add_argument("--url", help="corenlp URL, or several URLs of servers to balance the requests "
+                                                   "between", dest="url", type=str, nargs="+")
+    parser_corenlp_urls.add_argument("--url-file", help="File with one corenlp URL per line", dest="url_file",
+                                     type=str)
     parser_corenlp.add_argument("-n", "--n-jobs", help="Number of processes", dest="n_jobs", type=int, default=10,
                                 required=True)
+    parser_corenlp.add_argument("--delta", help="Only process the files of a delta list written by an incremental "
+                                                "extraction", dest="delta", type=str, default=None)
+    parser_corenlp.add_argument("--pool-size", help="Number of connections kept alive by each process (default: 10)",
+                                dest="pool_size", type=int, default=10)
+    parser_corenlp.add_argument("--timeout", help="Maximum number of seconds to wait for the answer to a request "
+                                                  "(default: 120)", dest="timeout", type=float, default=120)
+    parser_corenlp.add_argument("--engine", help="joblib: -n processes sending one request at a time, asyncio: one "
+                                                 "process with -n requests in flight (requires aiohttp) "
+                                                 "(default: joblib)", dest="engine", type=str,
+                                choices=["joblib", "asyncio"], default="joblib")
+    parser_corenlp.add_argument("--io-threads", help="Number of threads reading and writing files with the asyncio "
+                                                     "engine (default: 4)", dest="io_threads", type=int, default=4)
+    parser_corenlp.add_argument("--batch-chars", help="Pack short documents into requests of up to this number of "
+                                                      "characters (default: 0, one request per document)",
+                                dest="batch_chars", type=int, default=0)
+    parser_corenlp.add_argument("--chunk-chars", help="Split longer documents into chunks of up to this number of "
+                                                      "characters (default: 20000, 0 to disable)",
+                                dest="chunk_chars", type=int, default=20000)
+    parser_corenlp.add_argument("--chunk-threads", help="Number of chunks of a document sent concurrently by each "
+                                                        "process with the joblib engine (default: 4)",
+                                dest="chunk_threads", type=int, default=4)
+    parser_corenlp.add_argument("--retries", help="Number of times a failed request is sent again (default: 3)",
+                                dest="retries", type=int, default=3)
+    parser_corenlp.add_argument("--backoff", help="Seconds to wait before the first retry, doubled at each retry "
+                                                  "(default: 1.0)", dest="backoff", type=float, default=1.0)
+    parser_corenlp.add_argument("--retry-failed", help="Only process the files of the failed list written by a "
+                                                       "previous run in the output directory",
+                                action="store_true", dest="retry_failed")
+    parser_corenlp.add_argument("--resume", help="Resume an interrupted run, skipping files already processed",
+                                action="store_true", dest="resume")
+    parser_corenlp.add_argument("--backend", help="corenlp: CoreNLP servers given by --url or --url-file, other "
+                                                  "backends run in the -n processes without a server "
+                                                  "(default: corenlp)", dest="backend", type=str,
+                                choices=["corenlp"] + sorted(BACKENDS), default="corenlp")
+    parser_corenlp.add_argument("--cache", help="SQLite file where tokenized documents are cached, documents already "
+                                                "tokenized with the same options not being sent again",
+                                dest="cache", type=str, default=None)
+    parser_corenlp.add_argument("--cache-size", help="Maximum size of the cache in MB of tokenized text, least "
+                                                     "recently used documents being evicted (default: 10240)",
+                                dest="cache_size", type=int, default=10240)
+
+    # Agreement between a local tokenizer backend and CoreNLP
+    parser_compare = subparsers.add_parser('COMPARE-TOKENIZERS', help="Compare a local tokenizer backend with the "
+                                                                      "output of CoreNLP")
+    parser_compare.add_argument("--input-dir", help="Input directory, as given to CORENLP", dest="input_dir", type=str,
+                                required=True)
+    parser_compare.add_argument("--corenlp-dir", help="Output directory of CORENLP", dest="corenlp_dir", type=str,
+                                required=True)
+    parser_compare.add_argument("--backend", help="Local backend (default: regex)", dest="backend", type=str,
+                                choices=sorted(BACKENDS), default="regex")
+    parser_compare.add_argument("--sample-size", help="Number of files compared (default: 200)", dest="sample_size",
+                                type=int, default=200)
+    parser_compare.add_argument("--seed", help="Random seed of the sample (default: 777)", dest="seed", type=int,
+                                default=777)
+
+    # PREPARE A W2V TRAINING CORPUS
+    parser_prepare_w2v = subparsers.add_parser('PREPARE-W2V', help="Encode a tokenized corpus into token ids for "
+                                                                  "BUILD-W2V")
+    parser_prepare_w2v.add_argument("--corpus-dir", help="Tokenized corpus directory (CORENLP output)",
+                                    dest="corpus_dir", type=str, required=True)
+    parser_prepare_w2v.add_argument("--output-dir", help="Output directory, to be given to BUILD-W2V --corpus-dir",
+                                    dest="output_dir", type=str, required=True)
 
     # BUILD ONE W2V MODEL
     parser_build_w2v = subparsers.add_parser('BUILD-W2V', help="Build one word2vec model with gensim")
-    parser_build_w2v.add_argument("--corpus-dir", help="Input corpus directory", dest="corpus_dir", type=str,
-                                  required=True)
+    parser_build_w2v.add_argument("--corpus-dir", help="Input corpus directory (tokenized or prepared by PREPARE-W2V)",
+                                  dest="corpus_dir", type=str, required=True)
     parser_build_w2v.add_argument("--output-dir", help="Output directory where a subdirectory containing the mode will"
                                                        " be created", dest="output_dir", type=str, required=True)
     parser_build_w2v.add_argument("--size", help="Vector size (default: 100)", dest="size", type=int, default=100)
@@ -62,6 +184,9 @@ if __name__ == "__main__":
 
     parser_build_w2v.add_argument("-n", "--n-jobs", help="Number of processes (default: 1)", dest="n_jobs", type=int,
                                   default=1, required=True)
+    parser_build_w2v.add_argument("--shuffle-buffer", help="Number of lines held in memory to shuffle the corpus, 0 to "
+                                                           "disable (default: 100000)", dest="shuffle_buffer",
+                                  type=int, default=100000)
 
     args = parser.parse_args()
 
@@ -69,9 +194,24 @@ if __name__ == "__main__":
 
         target_dir = os.path.join(os.path.abspath(args.output_dir))
 
-        if os.path.isdir(target_dir):
+        if os.path.isdir(target_dir) and not args.incremental:
             raise IsADirectoryError("The output path you specified already exists")
 
+        # Arguments are checked before the output directory is created
+        if args.sample_ratio is not None and not 0 < args.sample_ratio <= 1:
+            parser_extract.error("--sample-ratio must be in ]0, 1]")
+
+        for id_path in [args.hadm_ids, args.subject_ids]:
+            if id_path is not None and not os.path.isfile(id_path):
+                parser_extract.error("the id list {} does not exist".format(id_path))
+
+        document_filter = build_document_filter(
+            categories=args.categories, chartdate_from=args.chartdate_from, chartdate_to=args.chartdate_to,
+            hadm_ids=load_id_list(args.hadm_ids) if args.hadm_ids else None,
+            subject_ids=load_id_list(args.subject_ids) if args.subject_ids else None,
+            sample_ratio=args.sample_ratio, sample_seed=args.sample_seed, exclude_errors=args.exclude_errors
+        )
+
         ensure_dir(target_dir)
 
         logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(message)s')
@@ -80,7 +220,10 @@ if __name__ == "__main__":
 
         start = time.time()
 
-        extract_mimic_documents(args.url, target_dir)
+        extract_mimic_documents(args.url, target_dir, batch_size=args.batch_size, n_writers=args.n_writers,
+                                n_jobs=args.n_jobs, range_size=args.range_size, output_format=args.output_format,
+                                incremental=args.incremental, detect_changes=args.detect_changes,
+                                document_filter=document_filter)
 
         end = time.time()
 
@@ -92,9 +235,16 @@ if __name__ == "__main__":
 
         target_dir = os.path.join(os.path.abspath(args.output_dir))
 
-        if os.path.isdir(target_dir):
+        if os.path.isdir(target_dir) and not (args.resume or args.delta):
             raise IsADirectoryError("The output path you specified already exists")
 
+        # Arguments are checked before the output directory is created
+        if args.mapping_scope == "subject" and args.subject_map is None:
+            parser_replace.error("--subject-map is required with --mapping-scope subject")
+
+        if args.subject_map is not None and not os.path.isfile(args.subject_map):
+            parser_replace.error("the subject map {} does not exist".format(args.subject_map))
+
         ensure_dir(target_dir)
 
         logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(message)s')
@@ -103,8 +253,11 @@ if __name__ == "__main__":
 
         start = time.time()
 
-        random.seed(args.seed)  # Added by dalgu90
-        replace_placeholders(args.input_dir, target_dir, args.list_dir)
+        replace_placeholders(args.input_dir, target_dir, args.list_dir, seed=args.seed, n_jobs=args.n_jobs,
+                             list_store_path=args.list_store, weighted_names=args.weighted_names,
+                             scope=args.mapping_scope, mapping_size=args.mapping_size,
+                             subject_map_path=args.subject_map, mapping_store_path=args.mapping_store,
+                             resume=args.resume, delta_path=args.delta)
 
         end = time.time()
 
@@ -114,9 +267,15 @@ if __name__ == "__main__":
 
         target_dir = os.path.join(os.path.abspath(args.output_dir))
 
-        if os.path.isdir(target_dir):
+        if os.path.isdir(target_dir) and not (args.resume or args.delta or args.retry_failed):
             raise IsADirectoryError("The output path you specified already exists")
 
+        if args.retry_failed and not os.path.isdir(target_dir):
+            raise NotADirectoryError("The output path you specified does not exist")
+
+        if args.backend == "corenlp" and args.url is None and args.url_file is None:
+            parser_corenlp.error("one of the arguments --url --url-file is required with the corenlp backend")
+
         ensure_dir(os.path.abspath(target_dir))
 
         logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(message)s')
@@ -126,9 +285,62 @@ if __name__ == "__main__":
         logging.info("* Input directory: {}".format(os.path.abspath(args.input_dir)))
         logging.info("* Output directory: {}".format(os.path.abspath(args.output_dir)))
 
+        urls = None
+        if args.backend != "corenlp":
+            logging.info("* Local backend: {}".format(args.backend))
+        else:
+            if args.url_file is not None:
+                urls = load_url_list(args.url_file)
+            else:
+                urls = args.url
+
+            logging.info("* CoreNLP servers: {}".format(", ".join(urls)))
+
+        start = time.time()
+
+        segment_and_tokenize(args.input_dir, target_dir, urls, n_jobs=args.n_jobs, delta_path=args.delta,
+                             pool_size=args.pool_size, timeout=args.timeout, engine=args.engine,
+                             io_threads=args.io_threads, batch_chars=args.batch_chars,
+                             chunk_chars=args.chunk_chars, chunk_threads=args.chunk_threads,
+                             retry_policy=RetryPolicy(args.retries, args.backoff, DEFAULT_RETRY_POLICY.max_backoff),
+                             retry_failed=args.retry_failed, resume=args.resume, backend=args.backend,
+                             cache_path=args.cache, cache_size=args.cache_size * 1024 ** 2)
+
+        end = time.time()
+
+        logging.info("Done ! (Time elapsed: {})".format(timedelta(seconds=round(end - start))))
+
+    elif args.subparser_name == "COMPARE-TOKENIZERS":
+
+        logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(message)s')
+
+        logging.info("Comparing tokenizers")
+        logging.info("====================")
+        logging.info("* Input directory: {}".format(os.path.abspath(args.input_dir)))
+        logging.info("* CoreNLP directory: {}".format(os.path.abspath(args.corenlp_dir)))
+
+        compare_tokenizations(args.input_dir, args.corenlp_dir, backend=args.backend, sample_size=args.sample_size,
+                              seed=args.seed)
+
+    elif args.subparser_name == "PREPARE-W2V":
+
+        target_dir = os.path.join(os.path.abspath(args.output_dir))
+
+        if os.path.isdir(target_dir):
+            raise IsADirectoryError("The output path you specified already exists")
+
+        ensure_dir(target_dir)
+
+        logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(message)s')
+
+        logging.info("Preparing word2vec corpus")
+        logging.info("=========================")
+        logging.info("* Corpus directory: {}".format(os.path.abspath(args.corpus_dir)))
+        logging.info("* Output directory: {}".format(target_dir))
+
         start = time.time()
 
-        segment_and_tokenize(args.input_dir, target_dir, args.url, n_jobs=args.n_jobs)
+        prepare_corpus(args.corpus_dir, target_dir)
 
         end = time.time()
 
@@ -187,13 +399,15 @@ if __name__ == "__main__":
         else:
             logging.info("* using cbow algorithm")
         logging.info("* number of processes: {}".format(args.n_jobs))
+        logging.info("* shuffle buffer: {} lines".format(args.shuffle_buffer))
 
         start = time.time()
 
         # Launching model computation
         build_model(args.corpus_dir, target_dir, model_prefix, size=args.size, window=args.window,
                     min_count=args.min_count, sg=model_type_num, n_jobs=args.n_jobs, iterations=args.iterations,
-                    neg_sample=args.neg_sample, sample=args.sample, alpha=args.alpha)
+                    neg_sample=args.neg_sample, sample=args.sample, alpha=args.alpha,
+                    shuffle_buffer_size=args.shuffle_buffer)
 
         end = time.time()
 
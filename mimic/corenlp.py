@@ -1,52 +1,247 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
-import re
+import random
+import sqlite3
+import threading
+import time
+from bisect import bisect_right
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import requests
+from requests.adapters import HTTPAdapter
 from joblib import Parallel, delayed
 
-from .tools import remove_abs, ensure_dir
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
-PARAMS = {"annotators": "tokenize,ssplit", "outputFormat": "json"}
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+from .manifest import largest_first, load_delta_list, load_manifest
+from .shards import ShardWriter, is_index, is_shard, read_shard
+from .tokenizer import get_backend
+from .tools import Checkpoint, atomic_open, ensure_dir
 
-def segment_and_tokenize(corpus_path, output_path, corenlp_url, n_jobs=10):
+# Sentences always end at two consecutive newlines, whether a document is sent alone or in a batch
+PARAMS = {"annotators": "tokenize,ssplit", "outputFormat": "json", "ssplit.newlineIsSentenceBreak": "two"}
+
+# Documents of a batched request are separated by two newlines, at which sentences always end
+BATCH_SEPARATOR = "\n\n"
+
+# Oversized documents are cut after a paragraph break, or else a line break, or else a space
+CHUNK_SEPARATORS = ["\n\n", "\n", " "]
+DEFAULT_CHUNK_CHARS = 20000
+
+# Seconds to wait for the connection to the server and for its answer
+CONNECT_TIMEOUT = 10
+DEFAULT_TIMEOUT = 120
+
+# Failed requests are retried `retries` times, waiting about `backoff` * 2 ** attempt seconds (at most `max_backoff`)
+RetryPolicy = namedtuple("RetryPolicy", ["retries", "backoff", "max_backoff"])
+DEFAULT_RETRY_POLICY = RetryPolicy(3, 1.0, 60.0)
+
+# After this number of consecutive failed requests, a server is ejected for a cooldown period
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+
+# Weight of the last request in the average latency of a server
+LATENCY_SMOOTHING = 0.2
+
+# Files of the output directory with dismissed chunks, processed again by CORENLP --retry-failed
+FAILED_LIST = ".corenlp-failed.txt"
+
+# Files of the output directory processed without dismissed chunks, skipped by CORENLP --resume
+CHECKPOINT = ".corenlp-checkpoint"
+
+# Files processed by a local backend are grouped up to this number of bytes per task
+LOCAL_GROUP_SIZE = 1000000
+
+# Default maximum size of the tokenization cache (bytes of tokenized text)
+DEFAULT_CACHE_SIZE = 10 * 1024 ** 3
+
+# HTTP session, server pool and tokenization cache of the process, created on first use so that each worker keeps
+# its own
+_session = None
+_endpoints = None
+_cache = None
+
+
+def segment_and_tokenize(corpus_path, output_path, corenlp_url, n_jobs=10, delta_path=None, pool_size=10,
+                         timeout=DEFAULT_TIMEOUT, engine="joblib", io_threads=4, batch_chars=0,
+                         chunk_chars=DEFAULT_CHUNK_CHARS, chunk_threads=4, retry_policy=DEFAULT_RETRY_POLICY,
+                         retry_failed=False, resume=False, backend="corenlp", cache_path=None,
+                         cache_size=DEFAULT_CACHE_SIZE):
     """
-    Segment and tokenize a corpus using CoreNLP
-    :param corpus_path: input corpus path (.txt files)
+    Segment and tokenize a corpus using CoreNLP. Files with dismissed chunks are listed in the failed list of the output
+    directory, the other ones in its checkpoint.
+    :param corpus_path: input corpus path (.txt files or .jsonl shards)
     :param output_path: path where tokenized versions will be stored
-    :param corenlp_url: CoreNLP server URL
-    :param n_jobs: number of processes to use
+    :param corenlp_url: CoreNLP server URL, or list of URLs of several servers
+    :param n_jobs: number of processes to use (joblib engine) or of requests in flight (asyncio engine)
+    :param delta_path: only process the files listed in this delta list (incremental extraction)
+    :param pool_size: maximum number of connections kept alive by each process (joblib engine)
+    :param timeout: maximum number of seconds to wait for the answer to a request
+    :param engine: "joblib" (one blocking request per process) or "asyncio" (one process, requires aiohttp)
+    :param io_threads: number of threads reading and writing files (asyncio engine)
+    :param batch_chars: pack documents into requests of up to this number of characters (0: one request per
+    document)
+    :param chunk_chars: split documents into chunks of up to this number of characters (0: documents are not split)
+    :param chunk_threads: number of chunks of a document sent concurrently by each process (joblib engine)
+    :param retry_policy: RetryPolicy of failed requests
+    :param retry_failed: only process the files of the failed list of the output directory
+    :param resume: skip the files listed in the checkpoint of a previous run
+    :param backend: "corenlp" (CoreNLP servers) or the name of a local backend run by the processes (e.g. "regex", the
+    server options being ignored)
+    :param cache_path: SQLite file where tokenized documents are cached (corenlp backend)
+    :param cache_size: maximum size of the cache (bytes of tokenized text), least recently used documents being
+    evicted at the end of the run
     :return: nothing
     """
 
-    processing_list = list()
+    if backend != "corenlp":
+        get_backend(backend)
+        engine = "joblib"
+
+    if engine == "asyncio" and aiohttp is None:
+        raise ImportError("The asyncio engine requires aiohttp (pip install aiohttp)")
 
     logging.info("Gathering file list")
 
-    for root, dirs, files in os.walk(os.path.abspath(corpus_path)):
-        for filename in files:
+    processing_list = list()
+    file_sizes = list()
+
+    failed_path = os.path.join(os.path.abspath(output_path), FAILED_LIST)
+
+    failed = set()
+    if os.path.isfile(failed_path):
+        failed = load_delta_list(failed_path)
+
+    delta = None
+    if delta_path is not None:
+        delta = load_delta_list(delta_path)
+    if retry_failed:
+        delta = failed if delta is None else delta & failed
+        logging.info("* Retrying {} failed files".format(len(delta)))
+
+    # Files are written atomically and recorded once written, so that an interrupted run can be resumed. The
+    # checkpoint of a previous run is only reset by a new full run: delta and retry runs add their files to it.
+    ensure_dir(os.path.abspath(output_path))
+
+    checkpoint_path = os.path.join(os.path.abspath(output_path), CHECKPOINT)
+    if not resume and delta is None and os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    checkpoint = Checkpoint(checkpoint_path)
+    if resume:
+        logging.info("* Resuming: {} files already processed".format(len(checkpoint)))
+
+    # Largest files first, so that the longest requests do not end up on a single worker at the end of the run
+    for entry in largest_first(load_manifest(corpus_path)):
+        if is_index(entry.path) or (delta is not None and entry.path not in delta):
+            continue
+
+        # Files recorded by a previous run and failed by a later delta or retry run are processed again
+        if resume and entry.path in checkpoint and entry.path not in failed:
+            continue
+
+        processing_list.append((
+            os.path.join(os.path.abspath(corpus_path), entry.path),
+            os.path.join(os.path.abspath(output_path), entry.path)
+        ))
+        file_sizes.append(entry.size)
+
+    for target_dir in sorted({os.path.dirname(target_file) for _, target_file in processing_list}):
+        ensure_dir(target_dir)
+
+    if cache_path is not None and backend == "corenlp":
+        # Creating the cache before the workers open it
+        logging.info("* Tokenization cache: {} ({:,} documents)".format(cache_path, len(TokenCache(cache_path))))
+    else:
+        cache_path = None
+
+    nb_files = len(processing_list)
+    dismissed = list()
+
+    def record(target_file, item):
+        # Files with dismissed chunks are processed again by a resumed run
+        if item[0] == 0:
+            checkpoint.add(os.path.relpath(target_file, os.path.abspath(output_path)))
+
+        dismissed.append((target_file, item))
+        if len(dismissed) % 1000 == 0 or len(dismissed) == nb_files:
+            logging.info("Processed: {}/{} files ({}%)".format(
+                len(dismissed), nb_files, round(float(len(dismissed) / nb_files) * 100, 2)
+            ))
+
+    start = time.time()
+
+    if engine == "asyncio":
+        logging.info("Starting processing with {} requests in flight".format(n_jobs))
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(_run_async(processing_list, corenlp_url, n_jobs, timeout, io_threads, batch_chars,
+                                               chunk_chars, retry_policy, record, cache_path))
+        finally:
+            loop.close()
+
+    else:
+        logging.info("Starting processing with {} jobs".format(n_jobs))
+
+        if backend == "corenlp":
+            # Small files are grouped so that their documents can be batched together
+            groups = _group_files(processing_list, file_sizes, batch_chars)
+            process_group = partial(_process_files, corenlp_url=corenlp_url, pool_size=pool_size, timeout=timeout,
+                                    batch_chars=batch_chars, chunk_chars=chunk_chars, chunk_threads=chunk_threads,
+                                    retry_policy=retry_policy, cache_path=cache_path)
+        else:
+            groups = _group_files(processing_list, file_sizes, LOCAL_GROUP_SIZE)
+            process_group = partial(_process_files_locally, backend=backend)
+
+        # Groups are recorded as soon as they are processed, so that a slow group does not hold back the checkpoint
+        with Parallel(n_jobs=n_jobs, return_as="generator_unordered") as parallel:
+            for group in parallel(delayed(process_group)(files) for files in groups):
+                for target_file, item in group:
+                    record(target_file, item)
+
+                checkpoint.flush()
+
+    checkpoint.close()
 
-            # Source file path
-            source_file = os.path.join(root, filename)
+    elapsed = time.time() - start
 
-            # Source file subdirectory path
-            subdir = remove_abs(re.sub(os.path.abspath(corpus_path), "", root))
+    if cache_path is not None:
+        cache = TokenCache(cache_path)
+        evicted = cache.evict(cache_size)
+        logging.info("* Tokenization cache: {:,} documents ({:,} evicted)".format(len(cache), evicted))
 
-            # Target
-            target_dir = os.path.join(os.path.abspath(output_path), subdir)
-            target_file = os.path.join(target_dir, filename)
+    # Failed files of previous runs stay in the list until they are processed successfully
+    processed = {os.path.relpath(target_file, os.path.abspath(output_path)) for target_file, _ in dismissed}
+    failed = (failed - processed) | {os.path.relpath(target_file, os.path.abspath(output_path))
+                                     for target_file, item in dismissed if item[0] > 0}
 
-            ensure_dir(target_dir)
+    with atomic_open(failed_path) as failed_file:
+        for failed_file_path in sorted(failed):
+            failed_file.write("{}\n".format(failed_file_path))
 
-            processing_list.append((source_file, target_file))
+    if failed:
+        logging.info("* Failed list: {} files ({}), process them again with --retry-failed".format(len(failed),
+                                                                                                 failed_path))
 
-    logging.info("* Number of files: {}".format(len(processing_list)))
-    logging.info("Starting processing with {} jobs".format(n_jobs))
+    dismissed = [item for _, item in dismissed]
+    nb_documents = sum([item[2] for item in dismissed])
 
-    dismissed = Parallel(n_jobs=n_jobs)(delayed(_process_file)(source_file, target_file, corenlp_url)
-                                        for source_file, target_file in processing_list)
+    logging.info("Processed: {:,} documents in {:.1f}s ({:.1f} docs/sec)".format(
+        nb_documents, elapsed, nb_documents / elapsed if elapsed > 0 else 0.0))
 
     logging.info("Dismissed: {:,} chunks, {:,} characters".format(
         sum([item[0] for item in dismissed]),
@@ -54,63 +249,933 @@ def segment_and_tokenize(corpus_path, output_path, corenlp_url, n_jobs=10):
     ))
 
 
-def _process_file(source_file, target_file, corenlp_url):
+def load_url_list(url_path):
     """
-    Process one file with CoreNLP. Files are chunked into pieces of roughly 20,000 characters.
-    :param source_file: source file path
-    :param target_file: target file path
-    :param corenlp_url: CoreNLP server URL
-    :return: dismissed chunks
+    Load a list of server URLs (one per line, lines starting with # are ignored)
+    :param url_path: file path
+    :return: list of URLs
     """
 
-    dismissed = [0, 0]
+    with open(url_path, "r", encoding="UTF-8") as url_file:
+        return [line.strip() for line in url_file if line.strip() and not line.startswith("#")]
 
-    content = open(source_file, "r", encoding="UTF-8").read()
 
-    with open(target_file, "w", encoding="UTF-8") as output_file:
-        payload = get_response(content, corenlp_url)
-        if payload:
-            for sentence in payload["sentences"]:
-                current_sentence = list()
+def _group_files(processing_list, file_sizes, batch_chars):
+    """
+    Group consecutive files up to a total size
+    :param processing_list: list of (source file, target file) tuples
+    :param file_sizes: file sizes
+    :param batch_chars: maximum size of a group (0: one file per group)
+    :return: list of lists of (source file, target file) tuples
+    """
 
-                for token in sentence["tokens"]:
-                    current_sentence.append(token["originalText"])
+    groups = list()
+    current_group = list()
+    current_size = 0
 
-                output_file.write("{}\n".format(" ".join(current_sentence)))
+    for files, file_size in zip(processing_list, file_sizes):
+        if current_group and current_size + file_size > batch_chars:
+            groups.append(current_group)
+            current_group = list()
+            current_size = 0
 
-        else:
-            dismissed[0] += 1
-            dismissed[1] += len(content)
+        current_group.append(files)
+        current_size += file_size
+
+    if current_group:
+        groups.append(current_group)
+
+    return groups
+
+
+def _process_files(files, corenlp_url, pool_size=10, timeout=DEFAULT_TIMEOUT, batch_chars=0,
+                   chunk_chars=DEFAULT_CHUNK_CHARS, chunk_threads=4, retry_policy=DEFAULT_RETRY_POLICY,
+                   cache_path=None):
+    """
+    Process files (or all the documents of shards) with CoreNLP. Documents found in the cache are not sent, short
+    documents are batched together, the chunks of oversized documents are sent concurrently.
+    :param files: list of (source file, target file) tuples
+    :param corenlp_url: CoreNLP server URL, or list of URLs of several servers
+    :param pool_size: maximum number of connections kept alive by the process
+    :param timeout: maximum number of seconds to wait for the answer to a request
+    :param batch_chars: pack documents into requests of up to this number of characters
+    :param chunk_chars: split documents into chunks of up to this number of characters
+    :param chunk_threads: number of chunks sent concurrently
+    :param retry_policy: RetryPolicy of failed requests
+    :param cache_path: SQLite file where tokenized documents are cached
+    :return: list of (target file, (dismissed chunks, dismissed characters, number of documents)), one per file
+    """
+
+    session = get_session(pool_size, len(get_endpoints(corenlp_url).urls))
+    cache = get_cache(cache_path, chunk_chars)
+
+    file_documents = [_read_documents(source_file) for source_file, _ in files]
+    contents = [content for documents in file_documents for _, content in documents]
+
+    cached = [cache.get(content) if cache is not None else None for content in contents]
+
+    # Cached documents are given a single chunk, already processed
+    chunks = [_get_chunks(content, chunk_chars) if sentences is None else [content]
+              for content, sentences in zip(contents, cached)]
+    results = [[None] * len(document_chunks) if sentences is None else [sentences]
+               for document_chunks, sentences in zip(chunks, cached)]
+
+    short_documents = [i for i, document_chunks in enumerate(chunks) if len(document_chunks) == 1
+                       and cached[i] is None]
+    for batch in _get_batches([contents[i] for i in short_documents], batch_chars):
+        batch_results = _tokenize_batch([contents[short_documents[j]] for j in batch], corenlp_url, session, timeout,
+                                        retry_policy)
+        for j, sentences in zip(batch, batch_results):
+            results[short_documents[j]][0] = sentences
+
+    long_chunks = [(i, k) for i, document_chunks in enumerate(chunks) if len(document_chunks) > 1
+                   for k in range(len(document_chunks))]
+    if long_chunks:
+        with ThreadPoolExecutor(max_workers=chunk_threads) as pool:
+            chunk_results = pool.map(lambda item: _tokenize(chunks[item[0]][item[1]], corenlp_url, session, timeout,
+                                                            retry_policy), long_chunks)
+
+            for (i, k), sentences in zip(long_chunks, chunk_results):
+                results[i][k] = sentences
+
+    results = [list(zip(document_chunks, chunk_results)) for document_chunks, chunk_results in zip(chunks, results)]
+
+    if cache is not None:
+        for content, sentences, chunk_results in zip(contents, cached, results):
+            if sentences is None:
+                cache.add_results(content, chunk_results)
+        cache.commit()
+
+    dismissed = list()
+    position = 0
+
+    for (_, target_file), documents in zip(files, file_documents):
+        dismissed.append((target_file, _write_documents(target_file, documents,
+                                                        results[position:position + len(documents)])))
+        position += len(documents)
+
+    return dismissed
+
+
+def _process_files_locally(files, backend):
+    """
+    Process files (or all the documents of shards) with a local backend
+    :param files: list of (source file, target file) tuples
+    :param backend: local backend name
+    :return: list of (target file, (dismissed chunks, dismissed characters, number of documents)), one per file
+    """
+
+    tokenize_text = get_backend(backend)
+    dismissed = list()
+
+    for source_file, target_file in files:
+        documents = _read_documents(source_file)
+        results = [[(content, tokenize_text(content))] for _, content in documents]
+
+        dismissed.append((target_file, _write_documents(target_file, documents, results)))
+
+    return dismissed
+
+
+def _read_documents(source_file):
+    """
+    Read the documents of a file
+    :param source_file: source file path (.txt file or .jsonl shard)
+    :return: list of (row_id, text) tuples, row_id being None for a .txt file
+    """
+
+    if is_shard(source_file):
+        return list(read_shard(source_file))
+
+    with open(source_file, "r", encoding="UTF-8") as input_file:
+        return [(None, input_file.read())]
+
+
+def _write_documents(target_file, documents, results):
+    """
+    Write the segmented and tokenized documents of a file, one sentence per line. The sentences of the chunks of a
+    document are concatenated in order; chunks that could not be processed are left out.
+    :param target_file: target file path (.txt file or .jsonl shard)
+    :param documents: list of (row_id, text) tuples
+    :param results: list of (chunk, sentence list or None if the chunk could not be processed) lists, one per document
+    :return: dismissed chunks, dismissed characters and number of documents
+    """
+
+    dismissed = [0, 0, len(documents)]
+    document_sentences = list()
+
+    for chunk_results in results:
+        sentences = list()
+
+        for chunk, chunk_sentences in chunk_results:
+            if chunk_sentences is None:
+                dismissed[0] += 1
+                dismissed[1] += len(chunk)
+            else:
+                sentences.extend(chunk_sentences)
+
+        document_sentences.append(sentences)
+
+    if is_shard(target_file):
+        with ShardWriter(target_file) as writer:
+            for (row_id, _), sentences in zip(documents, document_sentences):
+                writer.write(row_id, "".join(["{}\n".format(sentence) for sentence in sentences]))
+
+    else:
+        with atomic_open(target_file, "w", encoding="UTF-8") as output_file:
+            for sentences in document_sentences:
+                for sentence in sentences:
+                    output_file.write("{}\n".format(sentence))
 
     return dismissed
 
 
-def get_response(txt, corenlp_url):
+def _tokenize(content, corenlp_url, session=None, timeout=DEFAULT_TIMEOUT, retry_policy=DEFAULT_RETRY_POLICY):
+    """
+    Segment and tokenize a text with CoreNLP
+    :param content: text
+    :param corenlp_url: CoreNLP server URL, or list of URLs of several servers
+    :param session: HTTP session (default: session of the process)
+    :param timeout: maximum number of seconds to wait for the answer
+    :param retry_policy: RetryPolicy of failed requests
+    :return: None if the text could not be processed, list of sentences (space-separated tokens) otherwise
+    """
+
+    payload = get_response(content, corenlp_url, session, timeout, retry_policy=retry_policy)
+    if not payload:
+        return None
+
+    return _get_sentences(payload)
+
+
+def _get_sentences(payload):
+    """
+    Extract the sentences of a CoreNLP answer
+    :param payload: json response
+    :return: list of sentences (space-separated tokens)
+    """
+
+    sentences = list()
+
+    for sentence in payload["sentences"]:
+        current_sentence = list()
+
+        for token in sentence["tokens"]:
+            current_sentence.append(token["originalText"])
+
+        sentences.append(" ".join(current_sentence))
+
+    return sentences
+
+
+def _get_chunks(content, chunk_chars):
+    """
+    Split a document into chunks of up to chunk_chars characters, preferably after a paragraph or line break located
+    in the second half of the chunk. The concatenation of the chunks is the document.
+    :param content: document text
+    :param chunk_chars: maximum number of characters of a chunk (0: the document is not split)
+    :return: list of chunks
+    """
+
+    if not chunk_chars or len(content) <= chunk_chars:
+        return [content]
+
+    chunks = list()
+    start = 0
+
+    while len(content) - start > chunk_chars:
+        end = start + chunk_chars
+
+        for separator in CHUNK_SEPARATORS:
+            cut = content.rfind(separator, start, end)
+            if cut > start + chunk_chars // 2:
+                end = cut + len(separator)
+                break
+
+        chunks.append(content[start:end])
+        start = end
+
+    chunks.append(content[start:])
+
+    return chunks
+
+
+def _get_batches(contents, batch_chars):
+    """
+    Pack consecutive documents into batches of up to batch_chars characters. Longer documents are sent alone.
+    :param contents: document texts
+    :param batch_chars: maximum number of characters of a batch (0: one document per batch)
+    :return: list of lists of document indices
+    """
+
+    batches = list()
+    current_batch = list()
+    current_size = 0
+
+    for i, content in enumerate(contents):
+        size = len(content) + len(BATCH_SEPARATOR)
+
+        if current_batch and current_size + size > batch_chars:
+            batches.append(current_batch)
+            current_batch = list()
+            current_size = 0
+
+        current_batch.append(i)
+        current_size += size
+
+    if current_batch:
+        batches.append(current_batch)
+
+    return batches
+
+
+def _tokenize_batch(contents, corenlp_url, session=None, timeout=DEFAULT_TIMEOUT, retry_policy=DEFAULT_RETRY_POLICY):
+    """
+    Segment and tokenize several texts with one CoreNLP request. If the batch cannot be processed, texts are sent
+    one by one.
+    :param contents: texts
+    :param corenlp_url: CoreNLP server URL, or list of URLs of several servers
+    :param session: HTTP session (default: session of the process)
+    :param timeout: maximum number of seconds to wait for the answer
+    :param retry_policy: RetryPolicy of failed requests
+    :return: list of sentence lists (or None if a text could not be processed), one per text
+    """
+
+    if len(contents) == 1:
+        return [_tokenize(contents[0], corenlp_url, session, timeout, retry_policy)]
+
+    payload = get_response(BATCH_SEPARATOR.join(contents), corenlp_url, session, timeout,
+                           retry_policy=retry_policy)
+    if not payload:
+        return [_tokenize(content, corenlp_url, session, timeout, retry_policy) for content in contents]
+
+    return _split_sentences(payload, contents)
+
+
+def _split_sentences(payload, contents):
     """
-    Submit text to be tokenized to the CoreNLP server
+    Split the sentences of a batched request between its texts, using the offset of their first token. CoreNLP
+    offsets count UTF-16 code units.
+    :param payload: json response
+    :param contents: texts of the batch
+    :return: list of sentence lists, one per text
+    """
+
+    starts = list()
+    position = 0
+
+    for content in contents:
+        starts.append(position)
+        position += len(content.encode("UTF-16-LE")) // 2 + len(BATCH_SEPARATOR)
+
+    results = [list() for _ in contents]
+
+    for sentence in payload["sentences"]:
+        if not sentence["tokens"]:
+            continue
+
+        i = bisect_right(starts, sentence["tokens"][0]["characterOffsetBegin"]) - 1
+        results[i].append(" ".join([token["originalText"] for token in sentence["tokens"]]))
+
+    return results
+
+
+class TokenCache:
+    """
+    Disk-backed cache of tokenized documents (SQLite), keyed by a hash of the text and of the CoreNLP options. Several
+    processes can share the same cache: writes are kept in memory and written in one short transaction by commit(), so
+    that the database is never locked while requests are in flight.
+    """
+
+    def __init__(self, cache_path, chunk_chars=DEFAULT_CHUNK_CHARS, commit_every=1000):
+
+        self.connection = sqlite3.connect(cache_path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache (key BLOB PRIMARY KEY, sentences TEXT, "
+                                "size INTEGER, used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+        self.connection.commit()
+
+        # Chunk boundaries may end a sentence, so documents chunked differently are cached separately
+        self.options = json.dumps([PARAMS, chunk_chars], sort_keys=True).encode("UTF-8")
+
+        self.commit_every = commit_every
+        self.used = dict()
+        self.added = dict()
+
+    def __len__(self):
+
+        return self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get_key(self, content):
+
+        return hashlib.blake2b(self.options + b"\0" + content.encode("UTF-8"), digest_size=20).digest()
+
+    def get(self, content):
+        """
+        Get the sentences of a document
+        :param content: document text
+        :return: None or list of sentences
+        """
+
+        key = self.get_key(content)
+        row = self.connection.execute("SELECT sentences FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        self.used[key] = time.time()
+        self._add_pending()
+
+        return row[0].split("\n") if row[0] else list()
+
+    def add_results(self, content, chunk_results):
+        """
+        Cache a document if all its chunks were processed
+        :param content: document text
+        :param chunk_results: list of (chunk, sentence list or None) tuples
+        :return: nothing
+        """
+
+        if any([sentences is None for _, sentences in chunk_results]):
+            return
+
+        sentences = "\n".join([sentence for _, chunk_sentences in chunk_results for sentence in chunk_sentences])
+        self.added[self.get_key(content)] = (sentences, len(sentences), time.time())
+        self._add_pending()
+
+    def _add_pending(self):
+
+        if len(self.used) + len(self.added) >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        """
+        Write the pending documents and usage times
+        :return: nothing
+        """
+
+        if not self.used and not self.added:
+            return
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                                        [(key, sentences, size, used)
+                                         for key, (sentences, size, used) in self.added.items()])
+            self.connection.executemany("UPDATE cache SET used = ? WHERE key = ?",
+                                        [(used, key) for key, used in self.used.items() if key not in self.added])
+
+        self.used = dict()
+        self.added = dict()
+
+    def evict(self, max_size):
+        """
+        Remove the least recently used documents until the cache holds at most max_size bytes of tokenized text
+        :param max_size: maximum size
+        :return: number of documents removed
+        """
+
+        excess = (self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]) - max_size
+        if excess <= 0:
+            return 0
+
+        keys = list()
+        for key, size in self.connection.execute("SELECT key, size FROM cache ORDER BY used"):
+            if excess <= 0:
+                break
+            keys.append((key,))
+            excess -= size
+
+        self.connection.executemany("DELETE FROM cache WHERE key = ?", keys)
+        self.connection.commit()
+
+        return len(keys)
+
+
+def get_cache(cache_path, chunk_chars=DEFAULT_CHUNK_CHARS):
+    """
+    Get the tokenization cache of the process
+    :param cache_path: SQLite file (None: no cache)
+    :param chunk_chars: chunk size of the run
+    :return: None or TokenCache
+    """
+
+    global _cache
+
+    if cache_path is None:
+        return None
+
+    if _cache is None or _cache[0] != (cache_path, chunk_chars):
+        _cache = ((cache_path, chunk_chars), TokenCache(cache_path, chunk_chars))
+
+    return _cache[1]
+
+
+def get_session(pool_size=10, nb_servers=1):
+    """
+    Get the HTTP session of the process. Connections to the servers are kept alive and reused between requests.
+    :param pool_size: maximum number of connections kept alive to each server
+    :param nb_servers: number of servers
+    :return: requests session
+    """
+
+    global _session
+
+    if _session is None:
+        _session = requests.Session()
+
+        adapter = HTTPAdapter(pool_connections=nb_servers, pool_maxsize=pool_size)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+
+    return _session
+
+
+class CircuitBreaker:
+    """
+    Suspend the requests of a process to a server that keeps failing. After `threshold` consecutive failures, requests
+    wait for `cooldown` seconds; one request is then let through and the following ones wait for its outcome.
+    """
+
+    def __init__(self, name, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def get_wait(self):
+        """
+        Get the number of seconds to wait before sending a request
+        :return: 0 if the request can be sent
+        """
+
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+
+            wait = self.opened_at + self.cooldown - time.monotonic()
+            if wait > 0:
+                return min(wait, 1.0)
+
+            # Letting one request through, the next ones wait for another cooldown unless it succeeds
+            self.opened_at = time.monotonic()
+            return 0
+
+    def record(self, success):
+
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logging.warning("{} consecutive failed requests, ejecting {} for {}s".format(
+                        self.failures, self.name, self.cooldown))
+                self.opened_at = time.monotonic()
+
+
+class EndpointPool:
+    """
+    CoreNLP servers used by a process. Each request goes to a server with the fewest requests in flight, chosen at
+    random with a probability inversely proportional to its average latency. Servers are ejected by their circuit
+    breaker; once their cooldown is over, the next request probes them.
+    """
+
+    def __init__(self, urls, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+
+        self.urls = list(urls)
+        self.breakers = {url: CircuitBreaker(url, threshold, cooldown) for url in self.urls}
+        self.in_flight = {url: 0 for url in self.urls}
+        self.latency = {url: None for url in self.urls}
+        self.lock = threading.Lock()
+
+    def acquire(self, exclude=None):
+        """
+        Choose the server of a request
+        :param exclude: server to avoid if another one is available (e.g. the server that failed the previous attempt)
+        :return: (server URL, 0) or (None, number of seconds to wait before trying again if all servers are ejected)
+        """
+
+        with self.lock:
+            for url in self.urls:
+                if self.breakers[url].opened_at is not None and self.breakers[url].get_wait() == 0:
+                    return self._take(url)
+
+            available = [url for url in self.urls if self.breakers[url].opened_at is None]
+            if len(available) > 1 and exclude in available:
+                available.remove(exclude)
+            if not available:
+                return None, min([breaker.get_wait() for breaker in self.breakers.values()])
+
+            fewest = min([self.in_flight[url] for url in available])
+            candidates = [url for url in available if self.in_flight[url] == fewest]
+
+            # Servers without a measured latency are given the weight of the fastest one
+            weights = [1.0 / self.latency[url] for url in candidates if self.latency[url]]
+            default_weight = max(weights) if weights else 1.0
+            weights = [1.0 / self.latency[url] if self.latency[url] else default_weight for url in candidates]
+
+            return self._take(random.choices(candidates, weights=weights)[0])
+
+    def _take(self, url):
+
+        self.in_flight[url] += 1
+
+        return url, 0
+
+    def release(self, url, success, latency):
+        """
+        Record the outcome of a request
+        :param url: server URL
+        :param success: False if the server did not answer or answered with a server error
+        :param latency: number of seconds the request took
+        :return: nothing
+        """
+
+        with self.lock:
+            self.in_flight[url] -= 1
+            self.breakers[url].record(success)
+
+            if success:
+                if self.latency[url] is None:
+                    self.latency[url] = latency
+                else:
+                    self.latency[url] += LATENCY_SMOOTHING * (latency - self.latency[url])
+
+
+def get_endpoints(corenlp_url):
+    """
+    Get the server pool of the process
+    :param corenlp_url: CoreNLP server URL, or list of URLs of several servers
+    :return: EndpointPool
+    """
+
+    global _endpoints
+
+    urls = [corenlp_url] if isinstance(corenlp_url, str) else list(corenlp_url)
+
+    if _endpoints is None or _endpoints.urls != urls:
+        _endpoints = EndpointPool(urls)
+
+    return _endpoints
+
+
+async def _acquire_endpoint_async(endpoints, exclude=None):
+    """
+    Choose the server of a request, waiting while all servers are ejected (asyncio engine)
+    :param endpoints: EndpointPool
+    :param exclude: server to avoid if another one is available
+    :return: server URL
+    """
+
+    url, wait = endpoints.acquire(exclude)
+    while url is None:
+        await asyncio.sleep(wait)
+        url, wait = endpoints.acquire(exclude)
+
+    return url
+
+
+def _get_backoff(retry_policy, attempt):
+    """
+    Get the delay before a retry: exponential backoff with jitter, so that workers do not retry all at once
+    :param retry_policy: RetryPolicy
+    :param attempt: retry number (starting at 1)
+    :return: number of seconds
+    """
+
+    delay = min(retry_policy.max_backoff, retry_policy.backoff * 2 ** (attempt - 1))
+
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _is_retryable(status_code):
+    """
+    Check if a failed request may succeed when sent again (server overloaded or failing). Other errors depend on the
+    text and are not retried.
+    :param status_code: HTTP status code (None if no answer was received)
+    :return: boolean
+    """
+
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+def get_response(txt, corenlp_url, session=None, timeout=DEFAULT_TIMEOUT, params=PARAMS,
+                 retry_policy=DEFAULT_RETRY_POLICY):
+    """
+    Submit text to be tokenized to a CoreNLP server. Failed requests are retried with exponential backoff, possibly
+    on another server.
     :param txt: txt to be tokenized
-    :param corenlp_url: CoreNLP server URL
+    :param corenlp_url: CoreNLP server URL, or list of URLs of several servers
+    :param session: HTTP session (default: session of the process)
+    :param timeout: maximum number of seconds to wait for the answer
+    :param params: CoreNLP parameters
+    :param retry_policy: RetryPolicy of failed requests
     :return: None or json response
     """
 
-    try:
-        # Sending chunk to the server to be processed
-        r = requests.post(corenlp_url, params=PARAMS, data=txt.encode("UTF-8"))
-    except Exception as e:
-        print("Exception while sending request: \"{}\"".format(e))
-        return None
+    if session is None:
+        session = get_session()
+
+    endpoints = get_endpoints(corenlp_url)
+    url = None
+
+    for attempt in range(retry_policy.retries + 1):
+        if attempt > 0:
+            time.sleep(_get_backoff(retry_policy, attempt))
+
+        # Retries go to another server when possible
+        url, wait = endpoints.acquire(exclude=url)
+        while url is None:
+            time.sleep(wait)
+            url, wait = endpoints.acquire()
+
+        status_code = None
+        payload = None
+        start = time.monotonic()
+
+        try:
+            # Sending chunk to the server to be processed
+            r = session.post(url, params=params, data=txt.encode("UTF-8"), timeout=(CONNECT_TIMEOUT, timeout))
+        except Exception as e:
+            print("Exception while sending request: \"{}\"".format(e))
+        else:
+            status_code = r.status_code
+            payload = _decode_response(r.status_code, r.content)
+
+        success = payload is not None or not _is_retryable(status_code)
+        endpoints.release(url, success, time.monotonic() - start)
+
+        if success:
+            return payload
 
-    if r.status_code != 200:
+    return None
+
+
+def _decode_response(status_code, payload):
+    """
+    Decode the answer of the CoreNLP server. The UTF-8 body is decoded with orjson when it is installed (about twice
+    as fast on long documents), json being used otherwise or if orjson rejects the answer.
+    :param status_code: HTTP status code
+    :param payload: response body (bytes)
+    :return: None or json response
+    """
+
+    if status_code != 200:
         # Wrong code returned, skipping the chunk
         print("Skipping chunk, status code != 200")
         return None
 
+    if orjson is not None:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # e.g. unescaped control characters, accepted by json in non-strict mode
+            pass
+
     try:
-        payload = r.text
-        payload = json.loads(payload, strict=False)
+        payload = json.loads(payload.decode("UTF-8"), strict=False)
     except Exception as e:
         # Answer is not properly formatted, skipping the chunk
         print("Exception while parsing json: \"{}\"".format(e))
         return None
 
     return payload
+
+
+async def _run_async(processing_list, corenlp_url, concurrency, timeout, io_threads, batch_chars=0,
+                     chunk_chars=DEFAULT_CHUNK_CHARS, retry_policy=DEFAULT_RETRY_POLICY, on_done=None, cache_path=None):
+    """
+    Process files with CoreNLP from a single process, keeping up to `concurrency` requests in flight. Files are read
+    and written by a thread pool; documents are only read when a request slot is available.
+    :param processing_list: list of (source file, target file) tuples
+    :param corenlp_url: CoreNLP server URL, or list of URLs of several servers
+    :param concurrency: maximum number of requests in flight
+    :param timeout: maximum number of seconds to wait for the answer to a request
+    :param io_threads: number of threads reading and writing files
+    :param batch_chars: pack documents into requests of up to this number of characters
+    :param chunk_chars: split documents into chunks of up to this number of characters, sent as separate requests
+    :param retry_policy: RetryPolicy of failed requests
+    :param on_done: function called with the target file and (dismissed chunks, dismissed characters, number of
+    documents) of each file once written
+    :param cache_path: SQLite file where tokenized documents are cached
+    :return: list of (target file, (dismissed chunks, dismissed characters, number of documents)), one per file
+    """
+
+    loop = asyncio.get_event_loop()
+    in_flight = asyncio.Semaphore(concurrency)
+    dismissed = list()
+    tasks = set()
+
+    cache = TokenCache(cache_path, chunk_chars) if cache_path is not None else None
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    client_timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=timeout)
+
+    async def process_batch(session, batch):
+        try:
+            results = await _tokenize_batch_async(session, [job["results"][i][k][0] for job, i, k in batch],
+                                                  corenlp_url, client_timeout, retry_policy)
+        finally:
+            in_flight.release()
+
+        for (job, i, k), sentences in zip(batch, results):
+            job["results"][i][k] = (job["results"][i][k][0], sentences)
+
+            job["remaining"] -= 1
+            if job["remaining"] == 0:
+                await write(job)
+
+    async def write(job):
+        if cache is not None:
+            for i, ((_, content), chunk_results) in enumerate(zip(job["documents"], job["results"])):
+                if i not in job["cached"]:
+                    cache.add_results(content, chunk_results)
+            cache.commit()
+
+        done(job["target_file"], await loop.run_in_executor(io_pool, _write_documents, job["target_file"],
+                                                            job["documents"], job["results"]))
+
+    def done(target_file, item):
+        dismissed.append((target_file, item))
+        if on_done is not None:
+            on_done(target_file, item)
+
+    async def submit(session, batch):
+        # Backpressure: waiting for a request slot before submitting the next batch
+        await in_flight.acquire()
+
+        task = asyncio.ensure_future(process_batch(session, batch))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    with ThreadPoolExecutor(max_workers=io_threads) as io_pool:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            batch = list()
+            batch_size = 0
+
+            for source_file, target_file in processing_list:
+                documents = await loop.run_in_executor(io_pool, _read_documents, source_file)
+
+                if not documents:
+                    done(target_file, await loop.run_in_executor(io_pool, _write_documents, target_file, [], []))
+                    continue
+
+                # Each chunk is a separate item, so that the chunks of a document are processed concurrently. Cached
+                # documents are given a single chunk, already processed.
+                results = list()
+                job_cached = set()
+
+                for i, (_, content) in enumerate(documents):
+                    sentences = cache.get(content) if cache is not None else None
+                    if sentences is None:
+                        results.append([(chunk, None) for chunk in _get_chunks(content, chunk_chars)])
+                    else:
+                        results.append([(content, sentences)])
+                        job_cached.add(i)
+
+                job = {"target_file": target_file, "documents": documents, "results": results, "cached": job_cached,
+                       "remaining": sum([len(chunk_results) for i, chunk_results in enumerate(results)
+                                         if i not in job_cached])}
+
+                if job["remaining"] == 0:
+                    await write(job)
+                    continue
+
+                for i, chunk_results in enumerate(results):
+                    if i in job_cached:
+                        continue
+
+                    for k, (chunk, _) in enumerate(chunk_results):
+                        size = len(chunk) + len(BATCH_SEPARATOR)
+
+                        if batch and batch_size + size > batch_chars:
+                            await submit(session, batch)
+                            batch = list()
+                            batch_size = 0
+
+                        batch.append((job, i, k))
+                        batch_size += size
+
+            if batch:
+                await submit(session, batch)
+
+            await asyncio.gather(*list(tasks))
+
+    return dismissed
+
+
+async def _tokenize_batch_async(session, contents, corenlp_url, client_timeout, retry_policy=DEFAULT_RETRY_POLICY):
+    """
+    Segment and tokenize several texts with one CoreNLP request (asyncio engine). If the batch cannot be processed,
+    texts are sent one by one.
+    :param session: aiohttp session
+    :param contents: texts
+    :param corenlp_url: CoreNLP server URL, or list of URLs of several servers
+    :param client_timeout: aiohttp timeout
+    :param retry_policy: RetryPolicy of failed requests
+    :return: list of sentence lists (or None if a text could not be processed), one per text
+    """
+
+    if len(contents) == 1:
+        payload = await _get_response_async(session, contents[0], corenlp_url, client_timeout, PARAMS, retry_policy)
+        return [_get_sentences(payload) if payload else None]
+
+    payload = await _get_response_async(session, BATCH_SEPARATOR.join(contents), corenlp_url, client_timeout,
+                                        PARAMS, retry_policy)
+    if not payload:
+        return [(await _tokenize_batch_async(session, [content], corenlp_url, client_timeout, retry_policy))[0]
+                for content in contents]
+
+    return _split_sentences(payload, contents)
+
+
+async def _get_response_async(session, txt, corenlp_url, client_timeout, params, retry_policy=DEFAULT_RETRY_POLICY):
+    """
+    Submit text to be tokenized to a CoreNLP server (asyncio engine). Failed requests are retried with exponential
+    backoff, possibly on another server.
+    :param session: aiohttp session
+    :param txt: text to be tokenized
+    :param corenlp_url: CoreNLP server URL, or list of URLs of several servers
+    :param client_timeout: aiohttp timeout
+    :param params: CoreNLP parameters
+    :param retry_policy: RetryPolicy of failed requests
+    :return: None or json response
+    """
+
+    endpoints = get_endpoints(corenlp_url)
+    url = None
+
+    for attempt in range(retry_policy.retries + 1):
+        if attempt > 0:
+            await asyncio.sleep(_get_backoff(retry_policy, attempt))
+
+        # Retries go to another server when possible
+        url = await _acquire_endpoint_async(endpoints, exclude=url)
+
+        status_code = None
+        payload = None
+        start = time.monotonic()
+
+        try:
+            async with session.post(url, params=params, data=txt.encode("UTF-8"),
+                                    timeout=client_timeout) as r:
+                content = await r.read()
+                status_code = r.status
+                payload = _decode_response(r.status, content)
+        except Exception as e:
+            print("Exception while sending request: \"{}\"".format(e))
+
+        success = payload is not None or not _is_retryable(status_code)
+        endpoints.release(url, success, time.monotonic() - start)
+
+        if success:
+            return payload
+
+    return None
@@ -1,59 +1,545 @@
+import hashlib
 import logging
 import os
 import re
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from sqlalchemy import create_engine
+from sqlalchemy import bindparam, create_engine, text
+from sqlalchemy.engine import make_url
 
-from .tools import ensure_dir
+from .shards import SHARD_SUFFIX, ShardWriter, read_shard
+from .tools import atomic_open, ensure_dir
 
+# Number of documents per subdirectory (or per shard)
+DIR_DIVIDE = 1000
 
-def extract_mimic_documents(postgres_url, output_path):
+# Extraction manifest ("row_id<TAB>document path<TAB>md5" lines, the last line of a row_id wins) and list of the
+# files written by the last run, both stored in the output directory
+EXTRACT_MANIFEST = ".extract-manifest.tsv"
+DELTA_LIST = ".extract-delta.txt"
+
+# Document selection: category names (or None for all categories) and SQL predicate on the noteevents table (ne)
+DocumentFilter = namedtuple("DocumentFilter", ["categories", "clause", "parameters"])
+
+# Multiplicative hash of the subject_id used for sampling (Knuth), computed by the database
+SAMPLE_HASH = "((ne.subject_id + :sample_seed) * 2654435761) % 4294967296"
+
+
+def build_document_filter(categories=None, chartdate_from=None, chartdate_to=None, hadm_ids=None, subject_ids=None,
+                          sample_ratio=None, sample_seed=0, exclude_errors=False):
+    """
+    Build the selection of documents to extract. Filters are translated into SQL predicates evaluated by the database.
+    :param categories: list of categories, as stored in the database or as directory names (e.g. Discharge_summary)
+    :param chartdate_from: first chart date (YYYY-MM-DD, included)
+    :param chartdate_to: last chart date (YYYY-MM-DD, included)
+    :param hadm_ids: list of hospital admission ids
+    :param subject_ids: list of subject ids
+    :param sample_ratio: ratio of subjects to keep, chosen with a hash of the subject_id
+    :param sample_seed: seed of the subject sampling
+    :param exclude_errors: exclude the documents flagged as errors (iserror)
+    :return: DocumentFilter
+    """
+
+    predicates = list()
+    parameters = dict()
+
+    if chartdate_from is not None:
+        predicates.append("ne.chartdate >= :chartdate_from")
+        parameters["chartdate_from"] = chartdate_from
+
+    if chartdate_to is not None:
+        predicates.append("ne.chartdate <= :chartdate_to")
+        parameters["chartdate_to"] = chartdate_to
+
+    if hadm_ids is not None:
+        predicates.append("ne.hadm_id IN :hadm_ids")
+        parameters["hadm_ids"] = sorted(set(hadm_ids))
+
+    if subject_ids is not None:
+        predicates.append("ne.subject_id IN :subject_ids")
+        parameters["subject_ids"] = sorted(set(subject_ids))
+
+    if sample_ratio is not None:
+        if not 0 < sample_ratio <= 1:
+            raise ValueError("The sampling ratio must be in ]0, 1]")
+        predicates.append("{} < :sample_threshold".format(SAMPLE_HASH))
+        parameters["sample_seed"] = sample_seed
+        parameters["sample_threshold"] = int(sample_ratio * 4294967296)
+
+    if exclude_errors:
+        predicates.append("ne.iserror IS NULL")
+
+    return DocumentFilter(categories, "".join([" AND {}".format(predicate) for predicate in predicates]), parameters)
+
+
+def load_id_list(id_path):
+    """
+    Load a list of ids (one per line)
+    :param id_path: file path
+    :return: list of ids
+    """
+
+    with open(id_path, "r", encoding="UTF-8") as id_file:
+        return [int(line) for line in id_file if line.strip()]
+
+
+def _query(query, document_filter, parameters):
+    """
+    Add the predicates of a document filter to a query on the noteevents table (ne)
+    :param query: query, ending with a WHERE clause
+    :param document_filter: DocumentFilter
+    :param parameters: query parameters
+    :return: (SQLAlchemy text, parameters)
+    """
+
+    statement = text(query.replace("{FILTER}", document_filter.clause))
+
+    # Lists of ids are bound as expanding parameters (one parameter per id)
+    statement = statement.bindparams(*[bindparam(name, expanding=True)
+                                       for name, value in document_filter.parameters.items()
+                                       if isinstance(value, list)])
+
+    return statement, dict(parameters, **document_filter.parameters)
+
+
+def extract_mimic_documents(postgres_url, output_path, batch_size=1000, n_writers=4, n_jobs=1, range_size=50000,
+                            output_format="files", incremental=False, detect_changes=False, document_filter=None):
     """
     Extract mimic documents from the database.
     Regroup documents according to their categories.
+    Documents are streamed from a server-side cursor in batches and written by a pool of writer threads, so that
+    memory usage does not depend on the size of the categories. Categories are split into ranges of row_id which
+    are extracted concurrently, each over its own connection of the engine pool.
+    Every extracted document is recorded in a manifest. An incremental run only fetches the documents above the
+    highest row_id of the manifest, which are appended to their category as a full extraction would have placed them,
+    and optionally the documents whose content hash changed, which are rewritten in place. The files written by a run
+    are listed in the delta list of the output directory.
     :param postgres_url: database url where mimic-iii is stored
     :param output_path: path where files will be written
+    :param batch_size: number of documents fetched at once
+    :param n_writers: number of writer threads
+    :param n_jobs: number of ranges extracted concurrently
+    :param range_size: maximum number of documents per range (rounded up to a multiple of 1000)
+    :param output_format: "files" (category/NNNN/row_id.txt) or "jsonl" (category/NNNN.jsonl shards)
+    :param incremental: only extract the documents missing from the manifest of a previous run
+    :param detect_changes: also compare the content hashes of the documents already extracted (incremental mode)
+    :param document_filter: selection of documents to extract (DocumentFilter, default: all documents). An
+    incremental run must use the selection of the previous run.
     :return: nothing
     """
 
-    engine = create_engine(postgres_url)
-    _ = engine.connect()
+    if document_filter is None:
+        document_filter = build_document_filter()
+
+    manifest_path = os.path.join(output_path, EXTRACT_MANIFEST)
+
+    manifest = dict()
+    if incremental and os.path.isfile(manifest_path):
+        manifest = load_extract_manifest(manifest_path, output_format)
+
+    high_water_mark = max(manifest) if manifest else None
+
+    # Number of documents already extracted per category directory, new documents are appended after them
+    category_counts = Counter([document_path.split(os.sep)[0] for document_path, _ in manifest.values()])
+
+    # Ranges are aligned on subdirectories, so that a subdirectory or a shard is written by a single range
+    range_size = -(-range_size // DIR_DIVIDE) * DIR_DIVIDE
+
+    if make_url(postgres_url).get_backend_name() == "sqlite":
+        engine = create_engine(postgres_url)
+    else:
+        engine = create_engine(postgres_url, pool_size=n_jobs, max_overflow=n_jobs)
+
+    with engine.connect() as connection:
+
+        # Categories are selected by name among the categories stored in the database, then as a predicate
+        categories = [row.category for row in connection.execute(
+            text('SELECT category from mimiciii.noteevents GROUP BY category;')
+        )]
+
+        if document_filter.categories is not None:
+            categories = _select_categories(categories, document_filter.categories)
+            document_filter = document_filter._replace(
+                clause=" AND ne.category IN :categories{}".format(document_filter.clause),
+                parameters=dict(document_filter.parameters, categories=categories)
+            )
+
+        # Counting documents in database
+        document_count = connection.execute(
+            *_query('SELECT COUNT(*) FROM mimiciii.noteevents AS ne WHERE TRUE{FILTER};', document_filter, {})
+        ).scalar()
+        category_count = connection.execute(
+            *_query('SELECT COUNT(DISTINCT(category)) from mimiciii.noteevents AS ne WHERE TRUE{FILTER};',
+                    document_filter, {})
+        ).scalar()
+
+        logging.info("* Number of documents: {}".format(document_count))
+        logging.info("* NUmber of categories: {}".format(category_count))
+
+        if high_water_mark is not None:
+            logging.info("* Incremental extraction: {} documents already extracted, up to row_id {}".format(
+                len(manifest), high_water_mark))
+
+        logging.info("Starting extraction")
+
+        # Process:
+        # 1 - for each category, we split the documents into ranges of row_id
+        tasks = list()
+
+        for category in categories:
+            category_str = category.rstrip(" ")
+
+            # Category path
+            category_dir = re.sub(" ", "_", re.sub("/", "-", category_str))
+            cat_target_path = os.path.join(output_path, category_dir)
+
+            ranges = _split_category(connection, category, range_size, document_filter, high_water_mark,
+                                     category_counts[category_dir])
+
+            if ranges:
+                ensure_dir(cat_target_path)
+
+            logging.info("* {}: {} range(s)".format(category_str, len(ranges)))
+
+            for lower_row_id, upper_row_id, start_index in ranges:
+                tasks.append((category, cat_target_path, lower_row_id, upper_row_id, start_index))
+
+    # 2 - we stream the texts of each range. Manifest lines are staged in a temporary file and only added to the
+    # manifest once every range is written: an interrupted run is simply started again.
+    logging.info("* Extracting {} range(s) with {} jobs".format(len(tasks), n_jobs))
+
+    delta = set()
+    staged_path = "{}.staged".format(manifest_path)
+
+    with ThreadPoolExecutor(max_workers=n_writers) as writers, ThreadPoolExecutor(max_workers=n_jobs) as extractors, \
+            open(staged_path, "w", encoding="UTF-8") as staged_file:
+
+        if not manifest:
+            staged_file.write("#{}\n".format(output_format))
+
+        futures = [extractors.submit(_extract_range, engine, writers, batch_size, n_writers, output_format,
+                                     document_filter, *task)
+                   for task in tasks]
+
+        nb_documents = 0
+        for future in as_completed(futures):
+            for row_id, document_path, document_hash in future.result():
+                staged_file.write("{}\t{}\t{}\n".format(row_id, document_path, document_hash))
+                delta.add(_get_delta_path(document_path, output_format))
+                nb_documents += 1
+
+        logging.info("* Extracted documents: {}".format(nb_documents))
+
+        # 3 - we rewrite the documents whose content changed since the previous run
+        if detect_changes and manifest:
+            for row_id, document_path, document_hash in _update_changed(engine, output_path, output_format,
+                                                                        document_filter, manifest, high_water_mark,
+                                                                        batch_size):
+                staged_file.write("{}\t{}\t{}\n".format(row_id, document_path, document_hash))
+                delta.add(_get_delta_path(document_path, output_format))
+
+    with open(staged_path, "r", encoding="UTF-8") as staged_file, \
+            open(manifest_path, "a", encoding="UTF-8") as manifest_file:
+        for line in staged_file:
+            manifest_file.write(line)
+
+    os.remove(staged_path)
+
+    with atomic_open(os.path.join(output_path, DELTA_LIST)) as delta_file:
+        for delta_path in sorted(delta):
+            delta_file.write("{}\n".format(delta_path))
+
+    logging.info("* Delta list: {} files ({})".format(len(delta), os.path.join(output_path, DELTA_LIST)))
+
+
+def load_extract_manifest(manifest_path, output_format):
+    """
+    Load the manifest of a previous extraction
+    :param manifest_path: manifest path
+    :param output_format: output format of the current run, which must be the one of the previous run
+    :return: dictionary row_id -> (document path, md5 of the text)
+    """
+
+    manifest = dict()
+
+    with open(manifest_path, "r", encoding="UTF-8") as manifest_file:
+        for line in manifest_file:
+            if line.startswith("#"):
+                if line.rstrip("\n")[1:] != output_format:
+                    raise ValueError("The previous extraction used the {} output format".format(line.rstrip()[1:]))
+                continue
+
+            row_id, document_path, document_hash = line.rstrip("\n").split("\t")
+            manifest[int(row_id)] = (document_path, document_hash)
+
+    return manifest
+
+
+def _get_delta_path(document_path, output_format):
+    """
+    File holding a document: the document file itself or its shard
+    """
+
+    if output_format == "jsonl":
+        return "{}{}".format(os.path.dirname(document_path), SHARD_SUFFIX)
+
+    return document_path
+
+
+def _select_categories(categories, names):
+    """
+    Select categories by name
+    :param categories: categories, as stored in the database
+    :param names: category names, as stored in the database or as directory names
+    :return: selected categories
+    """
+
+    selected = list()
+    unknown = set(names)
+
+    for category in categories:
+        category_str = category.rstrip(" ")
+        category_dir = re.sub(" ", "_", re.sub("/", "-", category_str))
+
+        for name in (category, category_str, category_dir):
+            if name in names:
+                selected.append(category)
+                unknown.discard(name)
+
+    if unknown:
+        raise ValueError("Unknown categories: {}".format(", ".join(sorted(unknown))))
+
+    return sorted(set(selected))
+
+
+def _get_hash(document_text):
+
+    return hashlib.md5(document_text.encode("UTF-8")).hexdigest()
+
+
+def _split_category(connection, category, range_size, document_filter, high_water_mark=None, start_index=0):
+    """
+    Split the documents of a category into ranges of row_id (keyset pagination)
+    :param connection: database connection
+    :param category: category, as stored in the database
+    :param range_size: maximum number of documents per range
+    :param document_filter: DocumentFilter
+    :param high_water_mark: only split the documents above this row_id
+    :param start_index: number of documents of the category already extracted
+    :return: list of (lowest row_id, upper bound or None for the last range, index of the first document)
+    """
+
+    query = "SELECT row_id FROM mimiciii.noteevents AS ne WHERE ne.category = :category{FILTER}"
+    parameters = {"category": category}
+
+    if high_water_mark is not None:
+        query += " AND ne.row_id > :high_water_mark"
+        parameters["high_water_mark"] = high_water_mark
+
+    row_ids = connection.execution_options(stream_results=True).execute(
+        *_query(query + " ORDER BY row_id;", document_filter, parameters)
+    )
+
+    bounds = list()
+
+    # Ranges start on multiples of range_size, so that a subdirectory is still written by a single range when the
+    # extraction starts in the middle of one
+    for i, row in enumerate(row_ids, start_index):
+        if i % range_size == 0 or not bounds:
+            bounds.append((row.row_id, i))
+
+    upper_bounds = [lower for lower, _ in bounds[1:]] + [None]
+
+    return [(lower, upper, index) for (lower, index), upper in zip(bounds, upper_bounds)]
+
+
+def _extract_range(engine, writers, batch_size, n_writers, output_format, document_filter, category, cat_target_path,
+                   lower_row_id, upper_row_id, start_index):
+    """
+    Stream a range of documents of one category to disk
+    :param engine: SQLAlchemy engine
+    :param writers: writer thread pool
+    :param batch_size: number of documents fetched at once
+    :param n_writers: number of writer threads, at most two batches per thread are waiting to be written
+    :param output_format: "files" or "jsonl"
+    :param document_filter: DocumentFilter
+    :param category: category, as stored in the database
+    :param cat_target_path: category path
+    :param lower_row_id: lowest row_id of the range
+    :param upper_row_id: row_id following the range, None for the last range of the category
+    :param start_index: index of the first document of the range in the category
+    :return: list of (row_id, document path, md5 of the text) tuples
+    """
+
+    query = "SELECT row_id, text FROM mimiciii.noteevents AS ne WHERE ne.category = :category{FILTER} " \
+            "AND ne.row_id >= :lower"
+    parameters = {"category": category, "lower": lower_row_id}
+
+    if upper_row_id is not None:
+        query += " AND ne.row_id < :upper"
+        parameters["upper"] = upper_row_id
+
+    pending = list()
+    nb_documents = 0
+    extracted = list()
+    category_dir = os.path.basename(cat_target_path)
+
+    # Documents of the shard being filled (jsonl format)
+    shard_id = None
+    shard_records = list()
+
+    with engine.connect() as connection:
+        cat_documents = connection.execution_options(stream_results=True).execute(
+            *_query(query + " ORDER BY row_id;", document_filter, parameters)
+        )
+
+        while True:
+            rows = cat_documents.fetchmany(batch_size)
+            if not rows:
+                break
+
+            batch = list()
+
+            for document in rows:
+                current_dir_id = ((start_index + nb_documents) // DIR_DIVIDE) + 1
+                nb_documents += 1
+
+                extracted.append((document.row_id,
+                                  os.path.join(category_dir, "{:04d}".format(current_dir_id),
+                                               "{:09d}.txt".format(document.row_id)),
+                                  _get_hash(document.text)))
+
+                if output_format == "jsonl":
+                    if current_dir_id != shard_id and shard_records:
+                        pending.append(writers.submit(_write_shard, cat_target_path, shard_id, shard_records))
+                        shard_records = list()
+                    shard_id = current_dir_id
+                    shard_records.append((document.row_id, document.text))
+                else:
+                    target_dir = os.path.join(cat_target_path, "{:04d}".format(current_dir_id))
+                    batch.append((target_dir, "{:09d}.txt".format(document.row_id), document.text))
+
+            if batch:
+                pending.append(writers.submit(_write_batch, batch))
+
+            # Backpressure: waiting for the oldest batch when too many batches are queued
+            while len(pending) > 2 * n_writers:
+                pending.pop(0).result()
+
+    if shard_records:
+        pending.append(writers.submit(_write_shard, cat_target_path, shard_id, shard_records))
+
+    for future in pending:
+        future.result()
+
+    return extracted
+
+
+def _update_changed(engine, output_path, output_format, document_filter, manifest, high_water_mark, batch_size):
+    """
+    Rewrite the documents already extracted whose content changed. On PostgreSQL, hashes are computed by the database
+    so that only the changed texts are transferred.
+    :param engine: SQLAlchemy engine
+    :param output_path: path where files are written
+    :param output_format: "files" or "jsonl"
+    :param document_filter: DocumentFilter
+    :param manifest: dictionary row_id -> (document path, md5 of the text)
+    :param high_water_mark: highest row_id of the manifest
+    :param batch_size: number of documents fetched at once
+    :return: list of (row_id, document path, md5 of the text) tuples
+    """
+
+    hash_in_database = engine.dialect.name == "postgresql"
 
-    # Counting documents in database
-    document_count = engine.execute('SELECT COUNT(*) FROM mimiciii.noteevents;').scalar()
-    category_count = engine.execute('SELECT COUNT(DISTINCT(category)) from mimiciii.noteevents;').scalar()
+    if hash_in_database:
+        hash_query = "SELECT row_id, md5(text) AS hash FROM mimiciii.noteevents AS ne " \
+                     "WHERE ne.row_id <= :high_water_mark{FILTER}"
+    else:
+        hash_query = "SELECT row_id, text FROM mimiciii.noteevents AS ne WHERE ne.row_id <= :high_water_mark{FILTER}"
 
-    logging.info("* Number of documents: {}".format(document_count))
-    logging.info("* NUmber of categories: {}".format(category_count))
+    changed = list()
+    unknown = 0
 
-    logging.info("Starting extraction")
-    logging.info("* Fetching categories")
+    with engine.connect() as connection:
+        documents = connection.execution_options(stream_results=True).execute(
+            *_query(hash_query + ";", document_filter, {"high_water_mark": high_water_mark})
+        )
 
-    categories = engine.execute('SELECT category from mimiciii.noteevents GROUP BY category;')
+        while True:
+            rows = documents.fetchmany(batch_size)
+            if not rows:
+                break
 
-    dir_divide = 1000
+            for row in rows:
+                if row.row_id not in manifest:
+                    unknown += 1
+                    continue
 
-    # Process:
-    # 1 - for each category, we fetch all the texts that are related to it
-    for row in categories:
-        category_str = row["category"].rstrip(" ")
-        logging.info("* Processing: {}".format(category_str))
+                row_hash = row.hash if hash_in_database else _get_hash(row.text)
+                if row_hash != manifest[row.row_id][1]:
+                    changed.append(row.row_id)
 
-        # Category path
-        cat_target_path = os.path.join(output_path, re.sub(" ", "_", re.sub("/", "-", category_str)))
-        ensure_dir(cat_target_path)
+        logging.info("* Changed documents: {}".format(len(changed)))
+        if unknown:
+            logging.info("* Ignored documents below the high-water mark: {}".format(unknown))
 
-        # Step 1
-        cat_documents = engine.execute(
-            "SELECT row_id, text FROM mimiciii.NOTEEVENTS as ne WHERE ne.category='{}';".format(row["category"])
+        text_query = text("SELECT row_id, text FROM mimiciii.noteevents WHERE row_id IN :row_ids;").bindparams(
+            bindparam("row_ids", expanding=True)
         )
 
-        for i, document in enumerate(cat_documents):
-            current_dir_id = (i // dir_divide) + 1
-            target_dir = os.path.join(cat_target_path, "{:04d}".format(current_dir_id))
-            ensure_dir(target_dir)
+        updated = list()
+        for i in range(0, len(changed), batch_size):
+            for row in connection.execute(text_query, {"row_ids": changed[i:i + batch_size]}):
+                updated.append((row.row_id, manifest[row.row_id][0], row.text))
+
+    shards = dict()
+
+    for row_id, document_path, document_text in updated:
+        if output_format == "jsonl":
+            shard_path = _get_delta_path(document_path, output_format)
+            shards.setdefault(shard_path, list()).append((row_id, document_text))
+        else:
+            _write_batch([(os.path.join(output_path, os.path.dirname(document_path)), os.path.basename(document_path),
+                           document_text)])
+
+    for shard_path, records in shards.items():
+        _write_shard(os.path.join(output_path, os.path.dirname(shard_path)),
+                     int(os.path.basename(shard_path)[:-len(SHARD_SUFFIX)]), records)
+
+    return [(row_id, document_path, _get_hash(document_text)) for row_id, document_path, document_text in updated]
+
+
+def _write_batch(batch):
+    """
+    Write a batch of documents
+    :param batch: list of (target directory, filename, text) tuples
+    :return: nothing
+    """
+
+    for target_dir, filename, document_text in batch:
+        ensure_dir(target_dir)
+
+        with open(os.path.join(target_dir, filename), "w", encoding="UTF-8") as out:
+            out.write(document_text)
+
+
+def _write_shard(cat_target_path, shard_id, records):
+    """
+    Write the documents of one subdirectory as a shard. The records of an existing shard are kept, unless replaced.
+    :param cat_target_path: category path
+    :param shard_id: shard number
+    :param records: list of (row_id, text) tuples
+    :return: nothing
+    """
+
+    shard_path = os.path.join(cat_target_path, "{:04d}{}".format(shard_id, SHARD_SUFFIX))
 
-            target_file = os.path.join(target_dir, "{:09d}.txt".format(document["row_id"]))
+    if os.path.isfile(shard_path):
+        merged = dict(read_shard(shard_path))
+        merged.update(records)
+        records = sorted(merged.items())
 
-            with open(target_file, "w", encoding="UTF-8") as out:
-                out.write(document["text"])
+    with ShardWriter(shard_path) as writer:
+        for row_id, document_text in records:
+            writer.write(row_id, document_text)
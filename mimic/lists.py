@@ -0,0 +1,411 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+from array import array
+from collections.abc import Sequence
+
+# Lists of replacement elements: (list name, path relative to the list directory, file format, description)
+# "lines": one element per line, "census": 1990 US census name file, "unique": sorted set of lines
+LIST_FILES = [
+    ("addresses", "www.randomlists.com/addresses_random.lst", "lines", "Postal addresses"),
+    ("last_names", "1990_US_CENSUS/dist.all.last", "census", "Last names"),
+    ("first_names_male", "1990_US_CENSUS/dist.male.first", "census", "Male first names"),
+    ("first_names_female", "1990_US_CENSUS/dist.female.first", "census", "Female first names"),
+    ("phone_numbers", "generatedata.com/phone_numbers_random.lst", "lines", "Phone numbers"),
+    ("companies", "generatedata.com/companies_random.lst", "lines", "Companies"),
+    ("countries", "www.countries-list.info/countries.lst", "lines", "Countries"),
+    ("emails", "generatedata.com/emails_random.lst", "lines", "Emails"),
+    ("holidays", "misc/holidays.lst", "unique", "Holiday names"),
+    ("hospitals", "data.medicare.gov/hospitals.lst", "lines", "Hospital names"),
+    ("locations", "generatedata.com/locations_random.lst", "lines", "Location names"),
+    ("ssn", "generatedata.com/social_security_numbers_random.lst", "lines", "SSN"),
+    ("states", "misc/US_states.lst", "lines", "US_States"),
+    ("colleges", "talk.collegeconfidential.com/colleges.lst", "lines", "Colleges"),
+    ("wards_units", "misc/hospital_wards_units.lst", "lines", "Wards & Units"),
+    ("websites", "generatedata.com/websites_random.lst", "lines", "Websites"),
+]
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+          'November', 'December']
+
+STORE_MAGIC = b"MIMICLS1"
+STORE_VERSION = 2
+
+REGEX_NAME = re.compile(r"^(.*)\d+\.\d+\s+\d+\.\d+\s+\d+$")
+
+
+def load_replacement_lists(list_path):
+    """
+    Load the lists of replacement elements from the text files of the list directory
+    :param list_path: list directory path
+    :return: dictionary of lists
+    """
+
+    list_sub = dict()
+
+    logging.info("Loading lists")
+
+    for list_name, relative_path, file_format, description in LIST_FILES:
+        with open(os.path.join(os.path.abspath(list_path), relative_path), "r", encoding="UTF-8") as input_file:
+            if file_format == "census":
+                list_sub[list_name] = list()
+                for line in input_file:
+                    match_name = REGEX_NAME.match(line)
+                    if match_name:
+                        list_sub[list_name].append(match_name.group(1).rstrip())
+            elif file_format == "unique":
+                list_sub[list_name] = sorted({line.rstrip() for line in input_file if line != "\n"})
+            else:
+                list_sub[list_name] = [line.rstrip() for line in input_file if line != "\n"]
+
+        logging.info("* {}: {} [{} ...]".format(description, len(list_sub[list_name]),
+                                                ", ".join(list_sub[list_name][:3])))
+
+    list_sub["months"] = list(MONTHS)
+    list_sub["all_first_names"] = list_sub["first_names_female"] + list_sub["first_names_male"]
+
+    logging.info("* Combining female and male first names: {} [{} ...]".format(
+        len(list_sub["all_first_names"]),
+        ", ".join(list_sub["all_first_names"][:3])
+    ))
+
+    return list_sub
+
+
+def load_name_frequencies(list_path):
+    """
+    Load the frequencies of the 1990 US census names. Frequencies are rounded to 0.001%, the remaining mass of the
+    cumulative frequency is spread evenly over the names rounded to 0.
+    :param list_path: list directory path
+    :return: dictionary of weight lists, aligned with the lists returned by load_replacement_lists
+    """
+
+    frequencies = dict()
+
+    for list_name, relative_path, file_format, _ in LIST_FILES:
+        if file_format != "census":
+            continue
+
+        weights = list()
+        cumulative = 0.0
+
+        with open(os.path.join(os.path.abspath(list_path), relative_path), "r", encoding="UTF-8") as input_file:
+            for line in input_file:
+                if REGEX_NAME.match(line):
+                    fields = line.split()
+                    weights.append(float(fields[-3]))
+                    cumulative = float(fields[-2])
+
+        nb_zeros = weights.count(0.0)
+        if nb_zeros:
+            residual = cumulative - sum(weights)
+            if residual <= 0:
+                residual = nb_zeros * min([weight for weight in weights if weight > 0] or [1.0]) / 2
+            weights = [weight if weight > 0 else residual / nb_zeros for weight in weights]
+
+        frequencies[list_name] = weights
+
+    frequencies["all_first_names"] = frequencies["first_names_female"] + frequencies["first_names_male"]
+
+    return frequencies
+
+
+def build_alias_table(weights):
+    """
+    Build a Walker alias table (Vose's method) for sampling indices proportionally to weights in O(1)
+    :param weights: list of non-negative weights
+    :return: (probabilities, aliases) lists
+    """
+
+    nb_weights = len(weights)
+    total = float(sum(weights))
+
+    scaled = [weight * nb_weights / total for weight in weights]
+    probabilities = [1.0] * nb_weights
+    aliases = list(range(nb_weights))
+
+    small = [i for i, weight in enumerate(scaled) if weight < 1.0]
+    large = [i for i, weight in enumerate(scaled) if weight >= 1.0]
+
+    while small and large:
+        i = small.pop()
+        j = large.pop()
+
+        probabilities[i] = scaled[i]
+        aliases[i] = j
+
+        scaled[j] -= 1.0 - scaled[i]
+        if scaled[j] < 1.0:
+            small.append(j)
+        else:
+            large.append(j)
+
+    # Remaining indices have a probability of 1 up to rounding errors
+    return probabilities, aliases
+
+
+class AliasSampler:
+    """
+    Weighted sampling of list indices from an alias table. One draw uses a single call to rng.random().
+    """
+
+    def __init__(self, probabilities, aliases):
+
+        self.probabilities = probabilities
+        self.aliases = aliases
+        self.size = len(probabilities)
+
+    def draw(self, rng):
+
+        position = rng.random() * self.size
+        index = int(position)
+
+        if position - index < self.probabilities[index]:
+            return index
+        return self.aliases[index]
+
+
+class MappedList(Sequence):
+    """
+    Read-only list of strings stored in a memory-mapped list store: an array of offsets and a blob of UTF-8
+    encoded elements. Elements are only decoded when accessed.
+    """
+
+    def __init__(self, offsets, blob):
+
+        self.offsets = offsets
+        self.blob = blob
+        self.size = len(offsets) - 1
+
+    def __len__(self):
+
+        return self.size
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.size))]
+
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("list index out of range")
+
+        return str(self.blob[self.offsets[index]:self.offsets[index + 1]], "UTF-8")
+
+
+def _file_digest(file_path):
+
+    with open(file_path, "rb") as input_file:
+        return hashlib.sha1(input_file.read()).hexdigest()
+
+
+def _source_stats(list_path):
+
+    stats = dict()
+
+    for _, relative_path, _, _ in LIST_FILES:
+        file_stat = os.stat(os.path.join(os.path.abspath(list_path), relative_path))
+        stats[relative_path] = [file_stat.st_size, file_stat.st_mtime_ns]
+
+    return stats
+
+
+def build_list_store(list_path, store_path):
+    """
+    Parse the list directory and write a binary list store
+    :param list_path: list directory path
+    :param store_path: list store path
+    :return: nothing
+    """
+
+    list_sub = load_replacement_lists(list_path)
+    frequencies = load_name_frequencies(list_path)
+
+    header = {
+        "version": STORE_VERSION,
+        "sources": {relative_path: stat + [_file_digest(os.path.join(os.path.abspath(list_path), relative_path))]
+                    for relative_path, stat in _source_stats(list_path).items()},
+        "lists": dict(),
+        "alias_tables": dict()
+    }
+
+    sections = list()
+    position = 0
+
+    for list_name, elements in sorted(list_sub.items()):
+        encoded = [element.encode("UTF-8") for element in elements]
+
+        offsets = [0]
+        for element in encoded:
+            offsets.append(offsets[-1] + len(element))
+
+        offsets_bytes = array("Q", offsets).tobytes()
+        blob_bytes = b"".join(encoded)
+        padding = b"\0" * (-len(blob_bytes) % 8)
+
+        header["lists"][list_name] = {
+            "count": len(elements),
+            "offsets": position,
+            "blob": position + len(offsets_bytes),
+            "blob_size": len(blob_bytes)
+        }
+
+        sections.extend([offsets_bytes, blob_bytes, padding])
+        position += len(offsets_bytes) + len(blob_bytes) + len(padding)
+
+    for list_name, weights in sorted(frequencies.items()):
+        probabilities, aliases = build_alias_table(weights)
+
+        probabilities_bytes = array("d", probabilities).tobytes()
+        aliases_bytes = array("Q", aliases).tobytes()
+
+        header["alias_tables"][list_name] = {
+            "count": len(weights),
+            "probabilities": position,
+            "aliases": position + len(probabilities_bytes)
+        }
+
+        sections.extend([probabilities_bytes, aliases_bytes])
+        position += len(probabilities_bytes) + len(aliases_bytes)
+
+    header_bytes = json.dumps(header).encode("UTF-8")
+    header_bytes += b" " * (-(len(header_bytes) + len(STORE_MAGIC) + 8) % 8)
+
+    # Writing to a temporary file first, concurrent runs never see a partial store
+    temp_path = "{}.{}.tmp".format(store_path, os.getpid())
+
+    with open(temp_path, "wb") as output_file:
+        output_file.write(STORE_MAGIC)
+        output_file.write(struct.pack("<Q", len(header_bytes)))
+        output_file.write(header_bytes)
+        for section in sections:
+            output_file.write(section)
+
+    os.replace(temp_path, store_path)
+
+
+def _read_header(store_path):
+    """
+    Read the header of a list store
+    :param store_path: list store path
+    :return: None or a (header, position of the first section) tuple
+    """
+
+    with open(store_path, "rb") as input_file:
+        if input_file.read(len(STORE_MAGIC)) != STORE_MAGIC:
+            return None
+        header_size, = struct.unpack("<Q", input_file.read(8))
+        header = json.loads(input_file.read(header_size).decode("UTF-8"))
+
+    if header.get("version") != STORE_VERSION:
+        return None
+
+    return header, len(STORE_MAGIC) + 8 + header_size
+
+
+def is_list_store_valid(list_path, store_path):
+    """
+    Check that a list store exists and has been built from the current list files. Files whose size or
+    modification time changed are compared by content.
+    :param list_path: list directory path
+    :param store_path: list store path
+    :return: True if the store can be used
+    """
+
+    if not os.path.isfile(store_path):
+        return False
+
+    store_info = _read_header(store_path)
+    if store_info is None:
+        return False
+
+    header, _ = store_info
+    current_stats = _source_stats(list_path)
+
+    if set(current_stats) != set(header["sources"]):
+        return False
+
+    for relative_path, (size, mtime_ns) in current_stats.items():
+        stored_size, stored_mtime_ns, stored_digest = header["sources"][relative_path]
+
+        if size != stored_size:
+            return False
+
+        if mtime_ns != stored_mtime_ns and \
+                _file_digest(os.path.join(os.path.abspath(list_path), relative_path)) != stored_digest:
+            return False
+
+    return True
+
+
+def open_list_store(store_path, alias_tables=False):
+    """
+    Memory-map a list store. Processes mapping the same store share its pages.
+    :param store_path: list store path
+    :param alias_tables: also return the alias tables of the census name lists
+    :return: dictionary of MappedList, and dictionary of AliasSampler if alias_tables is True
+    """
+
+    store_info = _read_header(store_path)
+    if store_info is None:
+        raise ValueError("Not a list store: {}".format(store_path))
+
+    header, data_start = store_info
+
+    with open(store_path, "rb") as input_file:
+        data = memoryview(mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    lists = dict()
+
+    for list_name, info in header["lists"].items():
+        offsets_start = data_start + info["offsets"]
+        blob_start = data_start + info["blob"]
+
+        offsets = data[offsets_start:blob_start].cast("Q")
+        blob = data[blob_start:blob_start + info["blob_size"]]
+
+        lists[list_name] = MappedList(offsets, blob)
+
+    if not alias_tables:
+        return lists
+
+    samplers = dict()
+
+    for list_name, info in header["alias_tables"].items():
+        probabilities_start = data_start + info["probabilities"]
+        aliases_start = data_start + info["aliases"]
+
+        probabilities = data[probabilities_start:aliases_start].cast("d")
+        aliases = data[aliases_start:aliases_start + info["count"] * 8].cast("Q")
+
+        samplers[list_name] = AliasSampler(probabilities, aliases)
+
+    return lists, samplers
+
+
+def prepare_list_store(list_path, store_path=None):
+    """
+    Open the list store of a list directory, building it first if it is missing or outdated
+    :param list_path: list directory path
+    :param store_path: list store path (default: .lists.bin in the list directory)
+    :return: list store path
+    """
+
+    if store_path is None:
+        store_path = os.path.join(os.path.abspath(list_path), ".lists.bin")
+
+    if is_list_store_valid(list_path, store_path):
+        logging.info("Using list store: {}".format(store_path))
+    else:
+        logging.info("Building list store: {}".format(store_path))
+        build_list_store(list_path, store_path)
+
+    for list_name, elements in sorted(open_list_store(store_path).items()):
+        logging.info("* {}: {} [{} ...]".format(list_name, len(elements), ", ".join(elements[:3])))
+
+    return store_path
@@ -0,0 +1,143 @@
+import logging
+import os
+from collections import namedtuple
+
+# One corpus file: path relative to the corpus directory, size in bytes and modification time
+ManifestEntry = namedtuple("ManifestEntry", ["path", "size", "mtime_ns"])
+
+
+def scan_corpus(corpus_path):
+    """
+    Enumerate the files of a corpus with os.scandir. Hidden files and directories (temporary files, checkpoints,
+    manifests) are ignored.
+    :param corpus_path: corpus path
+    :return: (list of ManifestEntry, dictionary relative directory -> modification time)
+    """
+
+    entries = list()
+    directories = dict()
+
+    corpus_path = os.path.abspath(corpus_path)
+    stack = [""]
+
+    while stack:
+        relative_dir = stack.pop()
+        current_dir = os.path.join(corpus_path, relative_dir)
+
+        directories[relative_dir] = os.stat(current_dir).st_mtime_ns
+
+        with os.scandir(current_dir) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.name.startswith("."):
+                    continue
+
+                relative_path = os.path.join(relative_dir, dir_entry.name)
+
+                if dir_entry.is_dir():
+                    stack.append(relative_path)
+                elif dir_entry.is_file():
+                    file_stat = dir_entry.stat()
+                    entries.append(ManifestEntry(relative_path, file_stat.st_size, file_stat.st_mtime_ns))
+
+    entries.sort()
+
+    return entries, directories
+
+
+def _write_manifest(manifest_path, entries, directories):
+
+    temp_path = "{}.{}.tmp".format(manifest_path, os.getpid())
+
+    with open(temp_path, "w", encoding="UTF-8") as output_file:
+        for relative_dir, mtime_ns in sorted(directories.items()):
+            output_file.write("D\t{}\t{}\n".format(relative_dir, mtime_ns))
+        for entry in entries:
+            output_file.write("F\t{}\t{}\t{}\n".format(entry.path, entry.size, entry.mtime_ns))
+
+    os.replace(temp_path, manifest_path)
+
+
+def _read_manifest(corpus_path, manifest_path):
+    """
+    Read a cached manifest. The cache is only used if no directory of the corpus has been modified since it was
+    written (adding, removing or renaming a file changes the modification time of its directory).
+    :param corpus_path: corpus path
+    :param manifest_path: manifest path
+    :return: None or list of ManifestEntry
+    """
+
+    entries = list()
+
+    with open(manifest_path, "r", encoding="UTF-8") as input_file:
+        for line in input_file:
+            parts = line.rstrip("\n").split("\t")
+
+            if parts[0] == "D":
+                try:
+                    if os.stat(os.path.join(os.path.abspath(corpus_path), parts[1])).st_mtime_ns != int(parts[2]):
+                        return None
+                except OSError:
+                    return None
+            else:
+                entries.append(ManifestEntry(parts[1], int(parts[2]), int(parts[3])))
+
+    return entries
+
+
+def load_manifest(corpus_path, suffix=None, manifest_path=None, refresh=False):
+    """
+    Get the list of files of a corpus, from the cached manifest if it is still valid or by scanning the corpus
+    :param corpus_path: corpus path
+    :param suffix: only keep files ending with this suffix (e.g. ".txt")
+    :param manifest_path: manifest cache path (default: CORPUS.manifest.tsv, next to the corpus directory; a file
+    written inside the corpus would change the modification time of the corpus directory)
+    :param refresh: ignore the cached manifest
+    :return: list of ManifestEntry sorted by path
+    """
+
+    if manifest_path is None:
+        manifest_path = "{}.manifest.tsv".format(os.path.abspath(corpus_path))
+
+    entries = None
+
+    if not refresh and os.path.isfile(manifest_path):
+        entries = _read_manifest(corpus_path, manifest_path)
+        if entries is not None:
+            logging.info("* Using file manifest: {}".format(manifest_path))
+
+    if entries is None:
+        logging.info("* Scanning corpus: {}".format(os.path.abspath(corpus_path)))
+        entries, directories = scan_corpus(corpus_path)
+
+        try:
+            _write_manifest(manifest_path, entries, directories)
+        except OSError as e:
+            logging.info("* Could not write file manifest: {}".format(e))
+
+    if suffix is not None:
+        entries = [entry for entry in entries if entry.path.endswith(suffix)]
+
+    logging.info("* Number of files: {:,} ({:,} bytes)".format(len(entries), sum([entry.size for entry in entries])))
+
+    return entries
+
+
+def largest_first(entries):
+    """
+    Order entries by decreasing size, so that the longest tasks are scheduled first and workers finish together
+    :param entries: list of ManifestEntry
+    :return: sorted list of ManifestEntry
+    """
+
+    return sorted(entries, key=lambda entry: (-entry.size, entry.path))
+
+
+def load_delta_list(delta_path):
+    """
+    Load a delta list (files written by an incremental extraction)
+    :param delta_path: delta list path
+    :return: set of paths relative to the corpus directory
+    """
+
+    with open(delta_path, "r", encoding="UTF-8") as delta_file:
+        return {line.rstrip("\n") for line in delta_file if line.strip()}
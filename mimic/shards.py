@@ -0,0 +1,133 @@
+import json
+import os
+
+# Packed shard format: one JSON record per line ({"row_id": ..., "text": ...}) in a .jsonl file, with a sidecar
+# .idx file giving the byte offset and length of each record ("row_id<TAB>offset<TAB>length" lines)
+SHARD_SUFFIX = ".jsonl"
+INDEX_SUFFIX = ".idx"
+
+
+def is_shard(path):
+
+    return path.endswith(SHARD_SUFFIX)
+
+
+def is_index(path):
+
+    return path.endswith(INDEX_SUFFIX)
+
+
+def get_index_path(shard_path):
+
+    return "{}{}".format(shard_path[:-len(SHARD_SUFFIX)], INDEX_SUFFIX)
+
+
+def get_document_id(shard_id, row_id):
+    """
+    Identifier of a record, equal to the relative path the document has in the one-file-per-document layout
+    :param shard_id: shard path relative to the corpus directory (category/NNNN.jsonl)
+    :param row_id: record row_id
+    :return: document identifier (category/NNNN/row_id.txt)
+    """
+
+    return os.path.join(shard_id[:-len(SHARD_SUFFIX)], "{:09d}.txt".format(row_id))
+
+
+class ShardWriter:
+    """
+    Write records to a shard and its index. Both files are written to temporary files which replace the targets
+    once the writer is closed without error.
+    """
+
+    def __init__(self, shard_path):
+
+        self.shard_path = shard_path
+        self.temp_path = os.path.join(os.path.dirname(shard_path),
+                                      ".{}.{}.tmp".format(os.path.basename(shard_path), os.getpid()))
+        self.shard_file = open(self.temp_path, "wb")
+        self.index = list()
+        self.position = 0
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+        else:
+            self.shard_file.close()
+            os.remove(self.temp_path)
+
+    def write(self, row_id, text):
+
+        line = "{}\n".format(json.dumps({"row_id": row_id, "text": text})).encode("UTF-8")
+
+        self.shard_file.write(line)
+        self.index.append((row_id, self.position, len(line)))
+        self.position += len(line)
+
+    def close(self):
+
+        self.shard_file.close()
+
+        index_path = get_index_path(self.shard_path)
+        temp_path = os.path.join(os.path.dirname(index_path),
+                                 ".{}.{}.tmp".format(os.path.basename(index_path), os.getpid()))
+
+        with open(temp_path, "w", encoding="UTF-8") as index_file:
+            for row_id, offset, length in self.index:
+                index_file.write("{}\t{}\t{}\n".format(row_id, offset, length))
+
+        os.replace(temp_path, index_path)
+        os.replace(self.temp_path, self.shard_path)
+
+
+def read_shard(shard_path):
+    """
+    Read all the records of a shard sequentially
+    :param shard_path: shard path
+    :return: iterator over (row_id, text) tuples
+    """
+
+    with open(shard_path, "r", encoding="UTF-8") as shard_file:
+        for line in shard_file:
+            record = json.loads(line)
+            yield record["row_id"], record["text"]
+
+
+def load_index(shard_path):
+    """
+    Load the index of a shard
+    :param shard_path: shard path
+    :return: dictionary row_id -> (offset, length)
+    """
+
+    index = dict()
+
+    with open(get_index_path(shard_path), "r", encoding="UTF-8") as index_file:
+        for line in index_file:
+            row_id, offset, length = line.rstrip("\n").split("\t")
+            index[int(row_id)] = (int(offset), int(length))
+
+    return index
+
+
+def read_record(shard_path, row_id, index=None):
+    """
+    Read one record of a shard using its index
+    :param shard_path: shard path
+    :param row_id: record row_id
+    :param index: shard index (loaded if not given)
+    :return: text
+    """
+
+    if index is None:
+        index = load_index(shard_path)
+
+    offset, length = index[row_id]
+
+    with open(shard_path, "rb") as shard_file:
+        shard_file.seek(offset)
+        return json.loads(shard_file.read(length).decode("UTF-8"))["text"]
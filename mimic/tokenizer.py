@@ -0,0 +1,185 @@
+import logging
+import os
+import random
+import re
+from difflib import SequenceMatcher
+
+from .manifest import load_manifest
+from .shards import is_index, is_shard, read_shard
+
+# Titles and abbreviations keeping their period. Abbreviations frequent at the end of a sentence in MIMIC notes
+# (e.g. "mg.", "etc.") are not listed so that the sentence is ended.
+ABBREVIATIONS = ["Dr", "Drs", "Mr", "Mrs", "Ms", "Prof", "Sr", "Jr", "St", "vs", "approx", "Approx", "appt", "dept",
+                 "Dept", "Hosp", "Inc", "Fig", "fig", "No", "no", "Nos", "e.g", "i.e", "cf"]
+
+# English contractions are split as CoreNLP does ("don't" -> "do n't", "patient's" -> "patient 's"), with both
+# apostrophes
+CONTRACTION = re.compile(r"(?i)^(.+?)(n['’]t|['’](?:s|re|ll|ve|m|d))$")
+
+TOKEN = re.compile(r"""
+    (?<![^\n])\d{1,2}\.(?=[ \t])                                          # list numbers at the start of a line (1.)
+    | (?:""" + "|".join([re.escape(abbreviation) for abbreviation in ABBREVIATIONS]) + r""")\.(?![A-Za-z])
+    | (?:[A-Za-z]\.){2,}                                                  # dotted abbreviations (p.o., b.i.d.)
+    | \d+(?:\.\d+)?[A-Za-z]\w*                                            # numbers with a unit (40mg, 98.6F)
+    | [+-]?\d+(?:[.,:/-]\d+)*(?:-[A-Za-z]\w*(?:['’]\w+)?)*               # numbers, dates, 120/80, 81-year-old
+    | \w+(?:['’]\w+)?(?:[-/&+]\w+(?:['’]\w+)?)*                           # words (s/p, mg/dL, follow-up)
+    | \.{2,} | -{2,} | _{2,} | \*{2,} | ={2,}                             # repeated punctuation
+    | [^\w\s]                                                             # any other symbol
+""", re.VERBOSE)
+
+# Sentences end after these tokens, and the closing brackets and quotes that follow them
+SENTENCE_END = {".", "!", "?", "..."}
+CLOSING = {")", "]", "}", "\"", "'", "’", "”"}
+
+# Paragraphs (blank lines) always end a sentence, single newlines do not (as CoreNLP ssplit.newlineIsSentenceBreak=two)
+PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n\s*")
+
+
+def get_tokens(text):
+    """
+    Tokenize a text
+
+    >>> get_tokens("81-year-old man on 5-FU, 24-hour urine")
+    ['81-year-old', 'man', 'on', '5-FU', ',', '24-hour', 'urine']
+    >>> get_tokens("2-view CXR, BP 120/80, 10-15 mg")
+    ['2-view', 'CXR', ',', 'BP', '120/80', ',', '10-15', 'mg']
+    >>> get_tokens("patient's chart, patient’s chart, don’t, 81-year-old's")
+    ['patient', "'s", 'chart', ',', 'patient', '’s', 'chart', ',', 'do', 'n’t', ',', '81-year-old', "'s"]
+
+    :param text: text
+    :return: list of tokens
+    """
+
+    tokens = list()
+
+    for match in TOKEN.finditer(text):
+        token = match.group()
+
+        contraction = CONTRACTION.match(token) if "'" in token or "’" in token else None
+        if contraction is not None:
+            tokens.extend(contraction.groups())
+        else:
+            tokens.append(token)
+
+    return tokens
+
+
+def tokenize(text):
+    """
+    Segment and tokenize a text with regular expressions
+    :param text: text
+    :return: list of sentences (space-separated tokens)
+    """
+
+    sentences = list()
+
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        current_sentence = list()
+
+        for token in get_tokens(paragraph):
+            if token in CLOSING and current_sentence and current_sentence[-1] in SENTENCE_END:
+                current_sentence.append(token)
+                continue
+
+            if current_sentence and (current_sentence[-1] in SENTENCE_END or current_sentence[-1] in CLOSING and
+                                     len(current_sentence) > 1 and current_sentence[-2] in SENTENCE_END):
+                sentences.append(" ".join(current_sentence))
+                current_sentence = list()
+
+            current_sentence.append(token)
+
+        if current_sentence:
+            sentences.append(" ".join(current_sentence))
+
+    return sentences
+
+
+# Local tokenizer backends: name -> function taking a text and returning its sentences (space-separated tokens)
+BACKENDS = {"regex": tokenize}
+
+
+def get_backend(name):
+    """
+    Get a local tokenizer backend
+    :param name: backend name
+    :return: function taking a text and returning its sentences (space-separated tokens)
+    """
+
+    if name not in BACKENDS:
+        raise ValueError("Unknown tokenizer backend: {} (available: {})".format(name, ", ".join(sorted(BACKENDS))))
+
+    return BACKENDS[name]
+
+
+def _read_texts(file_path):
+    """
+    Read the texts of a file
+    :param file_path: file path (.txt file or .jsonl shard)
+    :return: list of texts
+    """
+
+    if is_shard(file_path):
+        return [text for _, text in read_shard(file_path)]
+
+    with open(file_path, "r", encoding="UTF-8") as input_file:
+        return [input_file.read()]
+
+
+def compare_tokenizations(corpus_path, reference_path, backend="regex", sample_size=200, seed=777):
+    """
+    Compare a local backend with the output of CoreNLP on a sample of files, and log the agreement: share of the
+    tokens found by both (tokens are aligned with difflib) and share of the sentences found identically by both.
+    :param corpus_path: input corpus path, as given to CORENLP
+    :param reference_path: CoreNLP output path
+    :param backend: local backend name
+    :param sample_size: number of files to compare
+    :param seed: random seed of the sample
+    :return: dictionary of agreement figures
+    """
+
+    tokenize_text = get_backend(backend)
+
+    entries = [entry for entry in load_manifest(corpus_path) if not is_index(entry.path)
+               and os.path.isfile(os.path.join(os.path.abspath(reference_path), entry.path))]
+
+    sample = random.Random(seed).sample(entries, min(sample_size, len(entries)))
+    logging.info("* Comparing {} files".format(len(sample)))
+
+    counts = {"reference_tokens": 0, "backend_tokens": 0, "matching_tokens": 0, "reference_sentences": 0,
+              "backend_sentences": 0, "matching_sentences": 0}
+
+    for entry in sample:
+        texts = _read_texts(os.path.join(os.path.abspath(corpus_path), entry.path))
+        references = _read_texts(os.path.join(os.path.abspath(reference_path), entry.path))
+
+        for text, reference in zip(texts, references):
+            reference_sentences = reference.splitlines()
+            backend_sentences = tokenize_text(text)
+
+            reference_tokens = [token for sentence in reference_sentences for token in sentence.split(" ") if token]
+            backend_tokens = [token for sentence in backend_sentences for token in sentence.split(" ") if token]
+
+            matcher = SequenceMatcher(None, reference_tokens, backend_tokens, autojunk=False)
+
+            counts["reference_tokens"] += len(reference_tokens)
+            counts["backend_tokens"] += len(backend_tokens)
+            counts["matching_tokens"] += sum([block.size for block in matcher.get_matching_blocks()])
+
+            counts["reference_sentences"] += len(reference_sentences)
+            counts["backend_sentences"] += len(backend_sentences)
+            counts["matching_sentences"] += len(set(reference_sentences) & set(backend_sentences))
+
+    report = dict(counts)
+    report["token_precision"] = counts["matching_tokens"] / max(counts["backend_tokens"], 1)
+    report["token_recall"] = counts["matching_tokens"] / max(counts["reference_tokens"], 1)
+    report["sentence_precision"] = counts["matching_sentences"] / max(counts["backend_sentences"], 1)
+    report["sentence_recall"] = counts["matching_sentences"] / max(counts["reference_sentences"], 1)
+
+    logging.info("Tokens: {:,} CoreNLP, {:,} {}, {:,} matching (precision {:.2%}, recall {:.2%})".format(
+        counts["reference_tokens"], counts["backend_tokens"], backend, counts["matching_tokens"],
+        report["token_precision"], report["token_recall"]))
+    logging.info("Sentences: {:,} CoreNLP, {:,} {}, {:,} identical (precision {:.2%}, recall {:.2%})".format(
+        counts["reference_sentences"], counts["backend_sentences"], backend, counts["matching_sentences"],
+        report["sentence_precision"], report["sentence_recall"]))
+
+    return report
@@ -1,4 +1,5 @@
 import os
+from contextlib import contextmanager
 
 
 def ensure_dir(directory):
@@ -25,3 +26,80 @@ def get_other_extension(filename, target_extension):
     basename, extension = os.path.splitext(filename)
 
     return "{0}.{1}".format(basename, target_extension)
+
+
+@contextmanager
+def atomic_open(path, mode="w", encoding="UTF-8"):
+    """
+    Open a hidden temporary file next to the target path. The temporary file replaces the target only once it has
+    been written and closed without error, so the target is never left partially written.
+    :param path: target file path
+    :param mode: opening mode ("w" or "wb")
+    :param encoding: text encoding (ignored in binary mode)
+    :return: file handle
+    """
+
+    temp_path = os.path.join(os.path.dirname(path), ".{}.{}.tmp".format(os.path.basename(path), os.getpid()))
+
+    try:
+        with open(temp_path, mode, encoding=None if "b" in mode else encoding) as output_file:
+            yield output_file
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class Checkpoint:
+    """
+    Append-only list of completed items (e.g. relative file paths), one per line. Lines are flushed regularly; items
+    lost in a crash are simply processed again.
+    """
+
+    def __init__(self, path, flush_every=100):
+
+        self.path = path
+        self.completed = set()
+        self.flush_every = flush_every
+        self.pending = 0
+
+        partial_line = False
+
+        if os.path.isfile(path):
+            with open(path, "r", encoding="UTF-8") as input_file:
+                for line in input_file:
+                    # A partially written last line is ignored
+                    partial_line = not line.endswith("\n")
+                    if not partial_line:
+                        self.completed.add(line.rstrip("\n"))
+
+        self.output_file = open(path, "a", encoding="UTF-8")
+
+        if partial_line:
+            self.output_file.write("\n")
+
+    def __contains__(self, item):
+
+        return item in self.completed
+
+    def __len__(self):
+
+        return len(self.completed)
+
+    def add(self, item):
+
+        self.completed.add(item)
+        self.output_file.write("{}\n".format(item))
+
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+
+        self.output_file.flush()
+        self.pending = 0
+
+    def close(self):
+
+        self.output_file.close()
@@ -1,1071 +1,665 @@
+import hashlib
 import logging
+import multiprocessing
 import os
 import random
 import re
+import sqlite3
+from collections import OrderedDict, namedtuple
 
-from .tools import ensure_dir, remove_abs
+from .lists import open_list_store, prepare_list_store
+from .manifest import largest_first, load_delta_list, load_manifest
+from .shards import ShardWriter, get_document_id, is_shard, load_index, read_shard
+from .tools import Checkpoint, atomic_open, ensure_dir
+
+# One replacement rule: regular expression matching the inside of a placeholder (between "[**" and "**]"), function
+# computing the replacement from a random generator and whether the replacement is stored in the placeholder mapping
+# so that identical placeholders are always replaced by the same value.
+PlaceholderRule = namedtuple("PlaceholderRule", ["pattern", "generator", "keyed"])
+
+
+def _choice(list_name):
+    return lambda mapper, rng, groups: mapper.choice(rng, list_name)
+
+
+def _choice_of(values):
+    return lambda mapper, rng, groups: rng.choice(values)
+
+
+def _number(lower, upper):
+    return lambda mapper, rng, groups: str(rng.randint(lower, upper))
+
+
+def _numbers(template, *bounds):
+    return lambda mapper, rng, groups: template.format(*[str(rng.randint(lower, upper)) for lower, upper in bounds])
+
+
+def _groups(template):
+    return lambda mapper, rng, groups: template.format(*groups)
+
+
+def _empty(mapper, rng, groups):
+    return ''
+
+
+def _full_name(mapper, rng, groups):
+    firstname = mapper.choice(rng, "all_first_names")
+    name = mapper.choice(rng, "last_names")
+    return "{} {}".format(firstname, name)
+
+
+def _initials(mapper, rng, groups):
+    firstname = mapper.choice(rng, "all_first_names")
+    name = mapper.choice(rng, "last_names")
+    return "{}{}".format(firstname[0:1], name[0:1])
+
+
+def _date_range(mapper, rng, groups):
+    year_begin, month_begin, day_begin, year_end, month_end, day_end = PlaceholderMapper._build_date_range(rng)
+    return "{}/{}/{}-{}/{}/{}".format(year_begin, month_begin, day_begin, year_end, month_end, day_end)
+
+
+def _year_digits(mapper, rng, groups):
+    return str(rng.randint(1950, 2016))[int(groups[0]):]
+
+
+def _numbered(prefix, generator):
+    """
+    Build the two rules of a placeholder category: with a trailing identifier (keyed) and without (not keyed)
+    :param prefix: regular expression of the category, including the trailing space
+    :param generator: replacement function
+    :return: list of rules
+    """
+
+    return [
+        PlaceholderRule(prefix + r"\d+", generator, True),
+        PlaceholderRule(prefix, generator, False)
+    ]
+
+
+# Placeholders found in MIMIC documents
+PLACEHOLDER_REGEX = re.compile(r"\[\*\*[^\[]*\*\*\]")
+
+# Ordered rule table, the first rule matching a placeholder is applied
+PLACEHOLDER_RULES = (
+    _numbered(r"Age over 90 ", _number(90, 100)) +
+    _numbered(r"Apartment Address\(\d+\) ", _choice("addresses")) +
+    _numbered(r"Attending Info ", _full_name) +
+    _numbered(r"CC Contact Info ", _choice("phone_numbers")) +
+    _numbered(r"Clip Number \(Radiology\) ", _number(1, 10000)) +
+    _numbered(r"Company ", _choice("companies")) +
+    _numbered(r"Country ", _choice("countries")) +
+    _numbered(r"Date (r|R)ange (\(\d+\) )?", _date_range) +
+    _numbered(r"Dictator Info ", _number(1, 10000)) +
+    _numbered(r"Doctor First Name ", _choice("all_first_names")) +
+    _numbered(r"Doctor Last Name (\(ambig\) )?", _choice("last_names")) +
+    _numbered(r"E-mail address ", _choice("emails")) +
+    _numbered(r"Female First Name \([^\[]+\) ", _choice("first_names_female")) +
+    _numbered(r"First Name(\d+)? (\([^\[]+\) )?", _choice("all_first_names")) +
+    _numbered(r"Holiday ", _choice("holidays")) +
+    _numbered(r"Hospital(\d+)? ", _choice("hospitals")) +
+    _numbered(r"Initials? \(NamePattern\d+\) ", _initials) +
+    _numbered(r"Job Number ", _number(1, 10000)) +
+    _numbered(r"Known firstname ", _choice("all_first_names")) +
+    _numbered(r"Known lastname ", _choice("last_names")) +
+    _numbered(r"Last Name ([^\[]+ )?", _choice("last_names")) +
+    _numbered(r"Location ([^\[]+ )?", _choice("locations")) +
+    _numbered(r"MD Number(\(\d+\) )?", _choice("phone_numbers")) +
+    _numbered(r"Male First Name (\([^[]+\) )?", _choice("all_first_names")) +
+    _numbered(r"Medical Record Number (\([^[]+\) )?", _number(1, 10000)) +
+    _numbered(r"Month \(only\) ", _choice("months")) +
+    _numbered(r"Month Day ", _number(1, 31)) +
+    _numbered(r"Month/Day (\(?\d+\)? )?", _numbers("{}/{}", (1, 12), (1, 31))) +
+    _numbered(r"Month/Year (\(?\d+\)? )?", _numbers("{}/{}", (1, 12), (1950, 2016))) +
+    _numbered(r"Month/Day/Year ", _numbers("{}/{}/{}", (1, 12), (1, 31), (1950, 2016))) +
+    _numbered(r"Name(\d+)? (\([^\[]+\) )?", _choice("last_names")) +
+    _numbered(r"Name Initial (\([^\[]*\) )?", _initials) +
+    _numbered(r"Numeric Identifier ", _number(1, 10000)) +
+    _numbered(r"Pager number ", _choice("phone_numbers")) +
+    _numbered(r"Provider Number ", _choice("phone_numbers")) +
+    _numbered(r"Serial Number ", _numbers("{}-{}-{}", (1, 10000), (1, 10000), (1, 10000))) +
+    _numbered(r"Social Security Number ", _choice("ssn")) +
+    _numbered(r"State ", _choice("states")) +
+    _numbered(r"Street Address(\(\d+\) )?", _choice("addresses")) +
+    _numbered(r"Telephone/Fax (\(\d+\) )?", _choice("phone_numbers")) +
+    _numbered(r"Unit Number ", _number(1, 10000)) +
+    [PlaceholderRule(r"(\d\d\d\d-\d?\d-\d?\d)", _groups("{}"), True)] +
+    _numbered(r"Year \((\d+) digits\) ", _year_digits) +
+    _numbered(r"Year/Month/Day ", _numbers("{}/{}/{}", (1950, 2016), (1, 12), (1, 31))) +
+    [PlaceholderRule(r"((January|February|March|April|May|June|July|August|"
+                     r"September|October|November|December) \d+)", _groups("{}"), True)] +
+    _numbered(r"Name Prefix \(Prefixes\) ", _choice_of(['Ms', 'Miss', 'Mrs', 'Mr', 'Dr', 'Prof'])) +
+    _numbered(r"PO Box ", _numbers("PO BOX {}", (1, 1000))) +
+    _numbered(r"Year/Month ", _numbers("{}/{}", (1950, 2016), (1, 12))) +
+    _numbered(r"Month Day Year (\(\d+\) )?", _numbers("{} {} {}", (1, 12), (1, 31), (1950, 2016))) +
+    _numbered(r"Month Year ", _numbers("{} {}", (1, 12), (1950, 2016))) +
+    _numbered(r"Day Month ", _numbers("{} {}", (1, 31), (1, 12))) +
+    _numbered(r"Day Month Year (\(\d+\) )?", _numbers("{} {} {}", (1, 31), (1, 12), (1950, 2016))) +
+    _numbered(r"State/Zipcode ", _number(1, 99999)) +
+    _numbered(r"Hospital Unit Number ", _choice("phone_numbers")) +
+    _numbered(r"University/College ", _choice("colleges")) +
+    _numbered(r"Hospital Ward Name ", _choice("wards_units")) +
+    _numbered(r"Hospital Unit Name ", _choice("wards_units")) +
+    _numbered(r"Wardname ", _choice("wards_units")) +
+    _numbered(r"URL ", _choice("websites")) +
+    [
+        PlaceholderRule(r" \d+", _empty, False),
+        PlaceholderRule(r"\s", _empty, False),
+        PlaceholderRule(r"(\d+)-/(\d+)", _groups("{}/{}"), True),
+        PlaceholderRule(r"(\d+)/(\d+)", _groups("{}/{}"), True),
+        PlaceholderRule(r"(\d+)-(\d+)", _groups("{}-{}"), True),
+        PlaceholderRule(r"-(\d+)/(\d+)", _groups("{}/{}"), True),
+        PlaceholderRule(r"(\d+-\d+-\d+)", _groups("{}"), True),
+        PlaceholderRule(r"(\d+)", _groups("{}"), True),
+        PlaceholderRule(r"[^\[]*", _empty, False)
+    ]
+)
+
+
+class PlaceholderRules:
+    """
+    Compiled version of an ordered rule table.
+    Rules are bucketed by the first character of the placeholder category. Each bucket is compiled into a single
+    alternation regex which keeps the original rule order, so that the first matching rule wins as if rules were
+    tried one after the other.
+    """
+
+    def __init__(self, rules):
+
+        self.rules = rules
+
+        # Rules whose first character is not a literal have to be tried for every placeholder
+        wildcard = [i for i, rule in enumerate(rules) if self._first_char(rule.pattern) is None]
+        first_chars = {self._first_char(rule.pattern) for rule in rules} - {None}
+
+        self.buckets = dict()
+        for char in first_chars:
+            self.buckets[char] = self._compile(sorted(
+                [i for i, rule in enumerate(rules) if self._first_char(rule.pattern) == char] + wildcard
+            ))
+
+        self.wildcard = self._compile(wildcard)
+
+    def match(self, placeholder):
+        """
+        Find the first rule matching a placeholder
+        :param placeholder: placeholder (e.g. "[**Known lastname 1234**]")
+        :return: None or a (rule, matched string, rule groups) tuple
+        """
+
+        regex, group_rules = self.buckets.get(placeholder[3:4], self.wildcard)
+
+        mo = regex.match(placeholder)
+        if not mo:
+            return None
+
+        rule, nb_groups = group_rules[mo.lastindex]
+
+        return rule, mo.group(0), mo.groups()[mo.lastindex:mo.lastindex + nb_groups]
+
+    def _compile(self, rule_ids):
+
+        branches = list()
+        group_rules = dict()
+        group_index = 1
+
+        for rule_id in rule_ids:
+            rule = self.rules[rule_id]
+            nb_groups = re.compile(rule.pattern).groups
+
+            branches.append("({})".format(rule.pattern))
+            group_rules[group_index] = (rule, nb_groups)
+            group_index += nb_groups + 1
+
+        return re.compile(r"\[\*\*(?:{})\*\*\]".format("|".join(branches))), group_rules
+
+    @staticmethod
+    def _first_char(pattern):
+
+        if pattern[0] in "\\()[]{}.*+?^$|" or pattern[1:2] in ("?", "*", "{"):
+            return None
+
+        return pattern[0]
+
+
+COMPILED_PLACEHOLDER_RULES = PlaceholderRules(PLACEHOLDER_RULES)
+
+
+def derive_seed(*parts):
+    """
+    Derive a random seed from several values. Unlike hash(), the result is stable across processes and runs.
+    :param parts: values (seed, document path, placeholder, ...)
+    :return: 64-bit integer seed
+    """
+
+    digest = hashlib.blake2b("\0".join([str(part) for part in parts]).encode("UTF-8"), digest_size=8).digest()
+
+    return int.from_bytes(digest, "big")
+
+
+# Scopes in which a keyed placeholder keeps the same replacement
+MAPPING_SCOPES = ["global", "category", "subject", "document"]
+
+
+class MappingStore:
+    """
+    Disk-backed placeholder mapping (SQLite). Replacements found in the store take precedence over generated ones,
+    which keeps them stable across runs. Several processes can share the same store: new replacements are kept in
+    memory and written in one short transaction by commit(), so that the database is not locked while documents are
+    processed.
+    """
+
+    def __init__(self, store_path, commit_every=1000):
+
+        self.connection = sqlite3.connect(store_path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS mapping (scope TEXT, placeholder TEXT, replacement TEXT, "
+                                "PRIMARY KEY (scope, placeholder))")
+        self.connection.commit()
+
+        self.commit_every = commit_every
+        self.pending = dict()
+
+    def get(self, scope_id, placeholder):
+
+        if (scope_id, placeholder) in self.pending:
+            return self.pending[(scope_id, placeholder)]
+
+        row = self.connection.execute("SELECT replacement FROM mapping WHERE scope = ? AND placeholder = ?",
+                                      (scope_id, placeholder)).fetchone()
+
+        return None if row is None else row[0]
+
+    def add(self, scope_id, placeholder, replacement):
+
+        self.pending[(scope_id, placeholder)] = replacement
+
+        if len(self.pending) >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+
+        if not self.pending:
+            return
+
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO mapping VALUES (?, ?, ?)",
+                                        [(scope_id, placeholder, replacement)
+                                         for (scope_id, placeholder), replacement in self.pending.items()])
+
+        self.pending = dict()
 
 
 class PlaceholderMapper:
+    """
+    Replace placeholders with random values.
+    Placeholders with an identifier (keyed rules) are replaced using a random generator seeded from (seed, scope,
+    placeholder) so that they get the same replacement in every document of the scope, whatever the process handling
+    the document. Other placeholders use a random generator seeded from (seed, document) at the beginning of each
+    document. Lists with a sampler (e.g. census names with an AliasSampler) are sampled with it instead of uniformly.
 
-    def __init__(self, lists_replacements):
+    Since keyed replacements can always be computed again, placeholder_mapping is only a cache: it holds at most
+    max_size entries (least recently used entries are evicted) and is cleared when a document or category scope
+    ends.
+    """
 
-        self.placeholder_mapping = {}
-        self.lists_replacements = lists_replacements
+    def __init__(self, lists_replacements, seed=777, rules=COMPILED_PLACEHOLDER_RULES, samplers=None,
+                 scope="global", max_size=100000, mapping_store=None):
 
-    def get_mapping(self, placeholder):
+        if scope not in MAPPING_SCOPES:
+            raise ValueError("Unknown mapping scope: {}".format(scope))
 
-        mo = re.match("\[\*\*Age over 90 \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = str(random.randint(90, 100))
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Age over 90 \*\*\]", placeholder)
-        if mo:
-            return str(random.randint(90, 100))
-
-        mo = re.match("\[\*\*Apartment Address\(\d+\) \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["addresses"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Apartment Address\(\d+\) \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["addresses"])
-
-        mo = re.match("\[\*\*Attending Info \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                firstname = random.choice(self.lists_replacements["all_first_names"])
-                name = random.choice(self.lists_replacements["last_names"])
-                self.placeholder_mapping[mo.group(0)] = "{} {}".format(firstname, name)
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Attending Info \*\*\]", placeholder)
-        if mo:
-            firstname = random.choice(self.lists_replacements["all_first_names"])
-            name = random.choice(self.lists_replacements["last_names"])
-            return "{} {}".format(firstname, name)
-
-        mo = re.match("\[\*\*CC Contact Info \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["phone_numbers"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*CC Contact Info \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["phone_numbers"])
-
-        mo = re.match("\[\*\*Clip Number \(Radiology\) \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = str(random.randint(1, 10000))
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Clip Number \(Radiology\) \*\*\]", placeholder)
-        if mo:
-            return str(random.randint(1, 10000))
-
-        mo = re.match("\[\*\*Company \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["companies"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Company \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["companies"])
-
-        mo = re.match("\[\*\*Country \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["countries"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Country \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["countries"])
-
-        mo = re.match("\[\*\*Date (r|R)ange (\(\d+\) )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                year_begin, month_begin, day_begin, year_end, month_end, day_end = self._build_date_range()
-                self.placeholder_mapping[mo.group(0)] = "{}/{}/{}-{}/{}/{}".format(
-                    year_begin,
-                    month_begin,
-                    day_begin,
-                    year_end,
-                    month_end,
-                    day_end
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Date (r|R)ange (\(\d+\) )?\*\*\]", placeholder)
-        if mo:
-            year_begin, month_begin, day_begin, year_end, month_end, day_end = self._build_date_range()
-            return "{}/{}/{}-{}/{}/{}".format(
-                year_begin,
-                month_begin,
-                day_begin,
-                year_end,
-                month_end,
-                day_end
-            )
-
-        mo = re.match("\[\*\*Dictator Info \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = str(random.randint(1, 10000))
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Dictator Info \*\*\]", placeholder)
-        if mo:
-            return str(random.randint(1, 10000))
-
-        mo = re.match("\[\*\*Doctor First Name \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["all_first_names"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Doctor First Name \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["all_first_names"])
-
-        mo = re.match("\[\*\*Doctor Last Name (\(ambig\) )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["last_names"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Doctor Last Name (\(ambig\) )?\*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["last_names"])
-
-        mo = re.match("\[\*\*E-mail address \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["emails"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*E-mail address \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["emails"])
-
-        mo = re.match("\[\*\*Female First Name \([^\[]+\) \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["first_names_female"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Female First Name \([^\[]+\) \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["first_names_female"])
-
-        mo = re.match("\[\*\*First Name(\d+)? (\([^\[]+\) )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["all_first_names"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*First Name(\d+)? (\([^\[]+\) )?\*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["all_first_names"])
-
-        mo = re.match("\[\*\*Holiday \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["holidays"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Holiday \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["holidays"])
-
-        mo = re.match("\[\*\*Hospital(\d+)? \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["hospitals"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Hospital(\d+)? \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["hospitals"])
-
-        mo = re.match("\[\*\*Initials? \(NamePattern\d+\) \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                firstname = random.choice(self.lists_replacements["all_first_names"])
-                name = random.choice(self.lists_replacements["last_names"])
-                self.placeholder_mapping[mo.group(0)] = "{}{}".format(firstname[0:1], name[0:1])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Initials? \(NamePattern\d+\) \*\*\]", placeholder)
-        if mo:
-            firstname = random.choice(self.lists_replacements["all_first_names"])
-            name = random.choice(self.lists_replacements["last_names"])
-            return "{}{}".format(firstname[0:1], name[0:1])
-
-        mo = re.match("\[\*\*Job Number \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = str(random.randint(1, 10000))
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Job Number \*\*\]", placeholder)
-        if mo:
-            return str(random.randint(1, 10000))
-
-        mo = re.match("\[\*\*Known firstname \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["all_first_names"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Known firstname \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["all_first_names"])
-
-        mo = re.match("\[\*\*Known lastname \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["last_names"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Known lastname \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["last_names"])
-
-        mo = re.match("\[\*\*Last Name ([^\[]+ )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["last_names"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Last Name ([^\[]+ )?\*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["last_names"])
-
-        mo = re.match("\[\*\*Location ([^\[]+ )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["locations"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Location ([^\[]+ )?\*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["locations"])
-
-        mo = re.match("\[\*\*MD Number(\(\d+\) )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["phone_numbers"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*MD Number(\(\d+\) )?\*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["phone_numbers"])
-
-        mo = re.match("\[\*\*Male First Name (\([^[]+\) )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["all_first_names"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Male First Name (\([^[]+\) )?\*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["all_first_names"])
-
-        mo = re.match("\[\*\*Medical Record Number (\([^[]+\) )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = str(random.randint(1, 10000))
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Medical Record Number (\([^[]+\) )?\*\*\]", placeholder)
-        if mo:
-            return str(random.randint(1, 10000))
-
-        mo = re.match("\[\*\*Month \(only\) \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["months"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Month \(only\) \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["months"])
-
-        mo = re.match("\[\*\*Month Day \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = str(random.randint(1, 31))
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Month Day \*\*\]", placeholder)
-        if mo:
-            return str(random.randint(1, 31))
-
-        mo = re.match("\[\*\*Month/Day (\(?\d+\)? )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{}/{}".format(
-                    str(random.randint(1, 12)),
-                    str(random.randint(1, 31))
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Month/Day (\(?\d+\)? )?\*\*\]", placeholder)
-        if mo:
-            return "{}/{}".format(
-                str(random.randint(1, 12)),
-                str(random.randint(1, 31))
-            )
-
-        mo = re.match("\[\*\*Month/Year (\(?\d+\)? )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{}/{}".format(
-                    str(random.randint(1, 12)),
-                    str(random.randint(1950, 2016))
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Month/Year (\(?\d+\)? )?\*\*\]", placeholder)
-        if mo:
-            return "{}/{}".format(
-                    str(random.randint(1, 12)),
-                    str(random.randint(1950, 2016))
-                )
-
-        mo = re.match("\[\*\*Month/Day/Year \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{}/{}/{}".format(
-                    str(random.randint(1, 12)),
-                    str(random.randint(1, 31)),
-                    str(random.randint(1950, 2016))
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Month/Day/Year \*\*\]", placeholder)
-        if mo:
-            return "{}/{}/{}".format(
-                    str(random.randint(1, 12)),
-                    str(random.randint(1, 31)),
-                    str(random.randint(1950, 2016))
-                )
-
-        mo = re.match("\[\*\*Name(\d+)? (\([^\[]+\) )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["last_names"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Name(\d+)? (\([^\[]+\) )?\*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["last_names"])
-
-        mo = re.match("\[\*\*Name Initial (\([^\[]*\) )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                firstname = random.choice(self.lists_replacements["all_first_names"])
-                name = random.choice(self.lists_replacements["last_names"])
-                self.placeholder_mapping[mo.group(0)] = "{}{}".format(firstname[0:1], name[0:1])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Name Initial (\([^\[]*\) )?\*\*\]", placeholder)
-        if mo:
-            firstname = random.choice(self.lists_replacements["all_first_names"])
-            name = random.choice(self.lists_replacements["last_names"])
-            return "{}{}".format(firstname[0:1], name[0:1])
-
-        mo = re.match("\[\*\*Numeric Identifier \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = str(random.randint(1, 10000))
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Numeric Identifier \*\*\]", placeholder)
-        if mo:
-            return str(random.randint(1, 10000))
-
-        mo = re.match("\[\*\*Pager number \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["phone_numbers"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Pager number \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["phone_numbers"])
-
-        mo = re.match("\[\*\*Provider Number \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["phone_numbers"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Provider Number \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["phone_numbers"])
-
-        mo = re.match("\[\*\*Serial Number \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{}-{}-{}".format(
-                    str(random.randint(1, 10000)),
-                    str(random.randint(1, 10000)),
-                    str(random.randint(1, 10000))
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Serial Number \*\*\]", placeholder)
-        if mo:
-            return "{}-{}-{}".format(
-                    str(random.randint(1, 10000)),
-                    str(random.randint(1, 10000)),
-                    str(random.randint(1, 10000))
-                )
-
-        mo = re.match("\[\*\*Social Security Number \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["ssn"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Social Security Number \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["ssn"])
-
-        mo = re.match("\[\*\*State \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["states"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*State \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["states"])
-
-        mo = re.match("\[\*\*Street Address(\(\d+\) )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["addresses"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Street Address(\(\d+\) )?\*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["addresses"])
-
-        mo = re.match("\[\*\*Telephone/Fax (\(\d+\) )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["phone_numbers"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Telephone/Fax (\(\d+\) )?\*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["phone_numbers"])
-
-        mo = re.match("\[\*\*Unit Number \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = str(random.randint(1, 10000))
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Unit Number \*\*\]", placeholder)
-        if mo:
-            return str(random.randint(1, 10000))
-
-        mo = re.match("\[\*\*(\d\d\d\d-\d?\d-\d?\d)\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = mo.group(1)
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Year \((\d+) digits\) \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = str(random.randint(1950, 2016))[int(mo.group(1)):]
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Year \((\d+) digits\) \*\*\]", placeholder)
-        if mo:
-            return str(random.randint(1950, 2016))[int(mo.group(1)):]
-
-        mo = re.match("\[\*\*Year/Month/Day \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{}/{}/{}".format(
-                    str(random.randint(1950, 2016)),
-                    str(random.randint(1, 12)),
-                    str(random.randint(1, 31))
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Year/Month/Day \*\*\]", placeholder)
-        if mo:
-            return "{}/{}/{}".format(
-                    str(random.randint(1950, 2016)),
-                    str(random.randint(1, 12)),
-                    str(random.randint(1, 31))
-                )
-
-        mo = re.match("\[\*\*((January|February|March|April|May|June|July|August|"
-                      "September|October|November|December) \d+)\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = mo.group(1)
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Name Prefix \(Prefixes\) \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(['Ms', 'Miss', 'Mrs', 'Mr', 'Dr', 'Prof'])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Name Prefix \(Prefixes\) \*\*\]", placeholder)
-        if mo:
-            return random.choice(['Ms', 'Miss', 'Mrs', 'Mr', 'Dr', 'Prof'])
-
-        mo = re.match("\[\*\*PO Box \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "PO BOX {}".format(
-                    str(random.randint(1, 1000))
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*PO Box \*\*\]", placeholder)
-        if mo:
-            return "PO BOX {}".format(
-                    str(random.randint(1, 1000))
-                )
-
-        mo = re.match("\[\*\*Year/Month \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{}/{}".format(
-                    str(random.randint(1950, 2016)),
-                    str(random.randint(1, 12))
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Year/Month \*\*\]", placeholder)
-        if mo:
-            return "{}/{}".format(
-                    str(random.randint(1950, 2016)),
-                    str(random.randint(1, 12))
-                )
-
-        mo = re.match("\[\*\*Month Day Year (\(\d+\) )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{} {} {}".format(
-                    str(random.randint(1, 12)),
-                    str(random.randint(1, 31)),
-                    str(random.randint(1950, 2016))
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Month Day Year (\(\d+\) )?\*\*\]", placeholder)
-        if mo:
-            return "{} {} {}".format(
-                    str(random.randint(1, 12)),
-                    str(random.randint(1, 31)),
-                    str(random.randint(1950, 2016))
-                )
-
-        mo = re.match("\[\*\*Month Year \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{} {}".format(
-                    str(random.randint(1, 12)),
-                    str(random.randint(1950, 2016))
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Month Year \*\*\]", placeholder)
-        if mo:
-            return "{} {}".format(
-                    str(random.randint(1, 12)),
-                    str(random.randint(1950, 2016))
-                )
-
-        mo = re.match("\[\*\*Day Month \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{} {}".format(
-                    str(random.randint(1, 31)),
-                    str(random.randint(1, 12))
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Day Month \*\*\]", placeholder)
-        if mo:
-            return "{} {}".format(
-                    str(random.randint(1, 31)),
-                    str(random.randint(1, 12))
-                )
-
-        mo = re.match("\[\*\*Day Month Year (\(\d+\) )?\d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{} {} {}".format(
-                    str(random.randint(1, 31)),
-                    str(random.randint(1, 12)),
-                    str(random.randint(1950, 2016))
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Day Month Year (\(\d+\) )?\*\*\]", placeholder)
-        if mo:
-            return "{} {} {}".format(
-                    str(random.randint(1, 31)),
-                    str(random.randint(1, 12)),
-                    str(random.randint(1950, 2016))
-                )
-
-        mo = re.match("\[\*\*State/Zipcode \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = str(random.randint(1, 99999))
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*State/Zipcode \*\*\]", placeholder)
-        if mo:
-            return str(random.randint(1, 99999))
-
-        mo = re.match("\[\*\*Hospital Unit Number \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["phone_numbers"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Hospital Unit Number \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["phone_numbers"])
-
-        mo = re.match("\[\*\*University/College \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["colleges"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*University/College \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["colleges"])
-
-        mo = re.match("\[\*\*Hospital Ward Name \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["wards_units"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Hospital Ward Name \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["wards_units"])
-
-        mo = re.match("\[\*\*Hospital Unit Name \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["wards_units"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Hospital Unit Name \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["wards_units"])
-
-        mo = re.match("\[\*\*Wardname \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["wards_units"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*Wardname \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["wards_units"])
-
-        mo = re.match("\[\*\*URL \d+\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = random.choice(self.lists_replacements["websites"])
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*URL \*\*\]", placeholder)
-        if mo:
-            return random.choice(self.lists_replacements["websites"])
-
-        mo = re.match("\[\*\* \d+\*\*\]", placeholder)
-        if mo:
-            return ''
-
-        mo = re.match("\[\*\*\s\*\*\]", placeholder)
-        if mo:
-            return ''
-
-        mo = re.match("\[\*\*(\d+)-/(\d+)\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{}/{}".format(
-                    mo.group(1),
-                    mo.group(2)
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*(\d+)/(\d+)\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{}/{}".format(
-                    mo.group(1),
-                    mo.group(2)
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*(\d+)-(\d+)\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{}-{}".format(
-                    mo.group(1),
-                    mo.group(2)
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*-(\d+)/(\d+)\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = "{}/{}".format(
-                    mo.group(1),
-                    mo.group(2)
-                )
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*(\d+-\d+-\d+)\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = mo.group(1)
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*(\d+)\*\*\]", placeholder)
-        if mo:
-            if mo.group(0) not in self.placeholder_mapping:
-                self.placeholder_mapping[mo.group(0)] = mo.group(1)
-            return self.placeholder_mapping[mo.group(0)]
-
-        mo = re.match("\[\*\*[^\[]*\*\*\]", placeholder)
-        if mo:
-            return ''
-            # return placeholder
+        self.placeholder_mapping = OrderedDict()
+        self.lists_replacements = lists_replacements
+        self.samplers = samplers or {}
+        self.rules = rules
+        self.seed = seed
+
+        self.scope = scope
+        self.scope_id = ""
+        self.max_size = max_size
+        self.mapping_store = mapping_store
+
+        self.rng = random.Random(seed)
+        self.key_rng = random.Random(seed)
+
+    def start_document(self, document_id, scope_id=""):
+        """
+        Reseed the document random generator and switch to the scope of the document
+        :param document_id: document identifier (e.g. path relative to the corpus directory)
+        :param scope_id: identifier of the mapping scope of the document (category, subject, ...)
+        :return: nothing
+        """
+
+        self.rng.seed(derive_seed(self.seed, document_id))
+
+        if scope_id != self.scope_id:
+            if self.scope in ("category", "document"):
+                self.placeholder_mapping.clear()
+            self.scope_id = scope_id
+
+    def choice(self, rng, list_name):
+        """
+        Draw one element of a replacement list
+        :param rng: random generator
+        :param list_name: replacement list name
+        :return: list element
+        """
+
+        if list_name in self.samplers:
+            return self.lists_replacements[list_name][self.samplers[list_name].draw(rng)]
+
+        return rng.choice(self.lists_replacements[list_name])
 
-    @staticmethod
-    def _build_date_range():
+    def get_mapping(self, placeholder):
 
-        year_begin = random.randint(1950, 2016)
-        month_begin = random.randint(1, 12)
-        day_begin = random.randint(1, 28)
+        found = self.rules.match(placeholder)
+        if found is None:
+            return None
 
-        year_end = random.randint(year_begin, year_begin + 2)
-        if year_end > year_begin:
-            month_end = random.randint(1, 12)
-            day_end = random.randint(1, 28)
-        else:
-            month_end = random.randint(month_begin, 12)
-            if month_end > month_begin:
-                day_end = random.randint(1, 28)
-            else:
-                day_end = random.randint(day_begin, 28)
+        rule, key, groups = found
 
-        return year_begin, month_begin, day_begin, year_end, month_end, day_end
+        if not rule.keyed:
+            return rule.generator(self, self.rng, groups)
 
+        try:
+            replacement = self.placeholder_mapping[key]
+            self.placeholder_mapping.move_to_end(key)
+            return replacement
+        except KeyError:
+            pass
 
-def replace_placeholders(corpus_path, output_path, list_path):
-
-    # Variable where lists of replacements will be stored
-    list_sub = {
-        'addresses': [],
-        'last_names': [],
-        'first_names_male': [],
-        'first_names_female': [],
-        'phone_numbers': [],
-        'companies': [],
-        'countries': [],
-        'emails': [],
-        'holidays': [],
-        'hospitals': [],
-        'locations': [],
-        'months': ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
-                   'October', 'November', 'December'],
-        'ssn': [],
-        'states': [],
-        'colleges': [],
-        'wards_units': [],
-        'websites': []
-    }
-
-    logging.info("Loading lists")
-
-    with open(os.path.join(os.path.abspath(list_path), "www.randomlists.com", "addresses_random.lst"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
+        replacement = None
+        if self.mapping_store is not None:
+            replacement = self.mapping_store.get(self.scope_id, key)
 
-            if re.match("^$", line):
-                continue
+        if replacement is None:
+            if self.scope == "global":
+                self.key_rng.seed(derive_seed(self.seed, key))
+            else:
+                self.key_rng.seed(derive_seed(self.seed, self.scope_id, key))
+            replacement = rule.generator(self, self.key_rng, groups)
 
-            list_sub["addresses"].append(line.rstrip())
+            if self.mapping_store is not None:
+                self.mapping_store.add(self.scope_id, key, replacement)
 
-    logging.info("* Postal addresses: {} [{} ...]".format(
-        len(list_sub["addresses"]),
-        list_sub["addresses"][0]
-    ))
+        self.placeholder_mapping[key] = replacement
+        if self.max_size and len(self.placeholder_mapping) > self.max_size:
+            self.placeholder_mapping.popitem(last=False)
 
-    regex_name = re.compile("^(.*)\d+\.\d+\s+\d+\.\d+\s+\d+$")
+        return replacement
 
-    with open(os.path.join(os.path.abspath(list_path), "1990_US_CENSUS", "dist.all.last"), "r",
-              encoding="UTF-8") as input_file:
-        for line in input_file:
-            match_name = regex_name.match(line)
-            if match_name:
-                list_sub["last_names"].append(match_name.group(1).rstrip())
+    def replace(self, content):
+        """
+        Replace all placeholders of a text
+        :param content: text
+        :return: text with placeholders replaced
+        """
 
-    logging.info("* Last names: {} [{} ...]".format(
-        len(list_sub["last_names"]),
-        ", ".join(list_sub["last_names"][:5])
-    ))
+        return PLACEHOLDER_REGEX.sub(lambda mo: self.get_mapping(mo.group(0)), content)
 
-    with open(os.path.join(os.path.abspath(list_path), "1990_US_CENSUS", "dist.male.first"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            match_name = regex_name.match(line)
-            if match_name:
-                list_sub["first_names_male"].append(match_name.group(1).rstrip())
+    def write_replaced(self, content, output_file):
+        """
+        Replace all placeholders of a text and write the result to a file, piece by piece
+        :param content: text
+        :param output_file: output file handle
+        :return: nothing
+        """
 
-    logging.info("* Male first names: {} [{} ...]".format(
-        len(list_sub["first_names_male"]),
-        ", ".join(list_sub["first_names_male"][:5])
-    ))
+        start = 0
 
-    with open(os.path.join(os.path.abspath(list_path), "1990_US_CENSUS", "dist.female.first"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            match_name = regex_name.match(line)
-            if match_name:
-                list_sub["first_names_female"].append(match_name.group(1).rstrip())
+        for mo in PLACEHOLDER_REGEX.finditer(content):
+            output_file.write(content[start: mo.start()])
+            output_file.write(self.get_mapping(mo.group(0)))
 
-    logging.info("* Female first names: {} [{} ...]".format(
-        len(list_sub["first_names_female"]),
-        ", ".join(list_sub["first_names_female"][:5])
-    ))
+            start = mo.end()
 
-    with open(os.path.join(os.path.abspath(list_path), "generatedata.com", "phone_numbers_random.lst"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            if re.match("^$", line):
-                continue
-            list_sub["phone_numbers"].append(line.rstrip())
+        output_file.write(content[start:])
 
-    logging.info("* Phone numbers: {} [{} ...]".format(
-        len(list_sub["phone_numbers"]),
-        ", ".join(list_sub["phone_numbers"][:2])
-    ))
+    @staticmethod
+    def _build_date_range(rng):
 
-    with open(os.path.join(os.path.abspath(list_path), "generatedata.com", "companies_random.lst"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            if re.match("^$", line):
-                continue
-            list_sub["companies"].append(line.rstrip())
+        year_begin = rng.randint(1950, 2016)
+        month_begin = rng.randint(1, 12)
+        day_begin = rng.randint(1, 28)
 
-    logging.info("* Companies: {} [{} ...]".format(
-        len(list_sub["companies"]),
-        ", ".join(list_sub["companies"][:2])
-    ))
+        year_end = rng.randint(year_begin, year_begin + 2)
+        if year_end > year_begin:
+            month_end = rng.randint(1, 12)
+            day_end = rng.randint(1, 28)
+        else:
+            month_end = rng.randint(month_begin, 12)
+            if month_end > month_begin:
+                day_end = rng.randint(1, 28)
+            else:
+                day_end = rng.randint(day_begin, 28)
 
-    with open(os.path.join(os.path.abspath(list_path), "www.countries-list.info", "countries.lst"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            if re.match("^$", line):
-                continue
-            list_sub["countries"].append(line.rstrip())
+        return year_begin, month_begin, day_begin, year_end, month_end, day_end
 
-    logging.info("* Countries: {} [{} ...]".format(
-        len(list_sub["countries"]),
-        ", ".join(list_sub["countries"][:4])
-    ))
 
-    with open(os.path.join(os.path.abspath(list_path), "generatedata.com", "emails_random.lst"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            if re.match("^$", line):
-                continue
-            list_sub["emails"].append(line.rstrip())
-
-    logging.info("* Emails: {} [{} ...]".format(
-        len(list_sub["emails"]),
-        ", ".join(list_sub["emails"][:2])
-    ))
-
-    with open(os.path.join(os.path.abspath(list_path), "misc", "holidays.lst"),
-              "r", encoding="UTF-8") as input_file:
-        temp_set = set()
-        for line in input_file:
-            if re.match("^$", line):
-                continue
-            temp_set.add(line.rstrip())
-        list_sub["holidays"] = sorted(list(temp_set))  # Changed by dalgu90
-#         list_sub["holidays"] = list(temp_set)
-
-    logging.info("* Holiday names: {} [{} ...]".format(
-        len(list_sub["holidays"]),
-        ", ".join(list_sub["holidays"][:2])
-    ))
-
-    with open(os.path.join(os.path.abspath(list_path), "data.medicare.gov", "hospitals.lst"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            if re.match("^$", line):
-                continue
-            list_sub["hospitals"].append(line.rstrip())
+# Placeholder mapper of the current process, see _init_worker
+_mapper = None
 
-    logging.info("* Hospital names: {} [{} ...]".format(
-        len(list_sub["hospitals"]),
-        ", ".join(list_sub["hospitals"][:2])
-    ))
 
-    with open(os.path.join(os.path.abspath(list_path), "generatedata.com", "locations_random.lst"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            if re.match("^$", line):
-                continue
-            list_sub["locations"].append(line.rstrip())
+def _init_worker(list_store_path, weighted_names, mapping_store_path, mapper_options):
 
-    logging.info("* Location names: {} [{} ...]".format(
-        len(list_sub["locations"]),
-        ", ".join(list_sub["locations"][:3])
-    ))
+    global _mapper
 
-    with open(os.path.join(os.path.abspath(list_path), "generatedata.com", "social_security_numbers_random.lst"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            if re.match("^$", line):
-                continue
-            list_sub["ssn"].append(line.rstrip())
+    lists_replacements, samplers = open_list_store(list_store_path, alias_tables=True)
+    mapping_store = MappingStore(mapping_store_path) if mapping_store_path else None
 
-    logging.info("* SSN: {} [{} ...]".format(
-        len(list_sub["ssn"]),
-        ", ".join(list_sub["ssn"][:3])
-    ))
+    _mapper = PlaceholderMapper(lists_replacements, samplers=samplers if weighted_names else None,
+                                mapping_store=mapping_store, **mapper_options)
 
-    with open(os.path.join(os.path.abspath(list_path), "misc", "US_states.lst"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            if re.match("^$", line):
-                continue
-            list_sub["states"].append(line.rstrip())
 
-    logging.info("* US_States: {} [{} ...]".format(
-        len(list_sub["states"]),
-        ", ".join(list_sub["states"][:3])
-    ))
+def _replace_file(source_file, target_file, document_id, scope_id):
+    """
+    Replace the placeholders of one file
+    :param source_file: source file path
+    :param target_file: target file path
+    :param document_id: document identifier used to seed the random generator
+    :param scope_id: mapping scope identifier
+    :return: document identifier
+    """
 
-    with open(os.path.join(os.path.abspath(list_path), "talk.collegeconfidential.com", "colleges.lst"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            if re.match("^$", line):
-                continue
-            list_sub["colleges"].append(line.rstrip())
+    _mapper.start_document(document_id, scope_id)
 
-    logging.info("* Colleges: {} [{} ...]".format(
-        len(list_sub["colleges"]),
-        ", ".join(list_sub["colleges"][:3])
-    ))
+    with open(source_file, "r", encoding="UTF-8") as input_file:
+        content = input_file.read()
 
-    with open(os.path.join(os.path.abspath(list_path), "misc", "hospital_wards_units.lst"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            if re.match("^$", line):
-                continue
-            list_sub["wards_units"].append(line.rstrip())
+    with atomic_open(target_file, "w", encoding="UTF-8") as output_file:
+        _mapper.write_replaced(content, output_file)
 
-    logging.info("* Wards & Units: {} [{} ...]".format(
-        len(list_sub["wards_units"]),
-        ", ".join(list_sub["wards_units"][:3])
-    ))
+    if _mapper.mapping_store is not None:
+        _mapper.mapping_store.commit()
 
-    with open(os.path.join(os.path.abspath(list_path), "generatedata.com", "websites_random.lst"),
-              "r", encoding="UTF-8") as input_file:
-        for line in input_file:
-            if re.match("^$", line):
-                continue
-            list_sub["websites"].append(line.rstrip())
+    return document_id
 
-    logging.info("* Websites: {} [{} ...]".format(
-        len(list_sub["websites"]),
-        ", ".join(list_sub["websites"][:3])
-    ))
 
-    list_sub["all_first_names"] = list_sub["first_names_female"] + list_sub["first_names_male"]
+def _replace_shard(source_file, target_file, shard_id, shard_subjects):
+    """
+    Replace the placeholders of all the documents of a shard
+    :param source_file: source shard path
+    :param target_file: target shard path
+    :param shard_id: shard path relative to the corpus directory
+    :param shard_subjects: dictionary row_id -> subject_id for the documents of the shard (subject scope)
+    :return: shard identifier
+    """
 
-    logging.info("* Combining female and male first names: {} [{} ...]".format(
-        len(list_sub["all_first_names"]),
-        ", ".join(list_sub["all_first_names"][:3])
-    ))
+    with ShardWriter(target_file) as writer:
+        for row_id, content in read_shard(source_file):
+            document_id = get_document_id(shard_id, row_id)
 
-    logging.info("Creating mapper")
-    mapper = PlaceholderMapper(list_sub)
+            _mapper.start_document(document_id, _get_scope_id(_mapper.scope, document_id, shard_subjects))
+            writer.write(row_id, _mapper.replace(content))
 
-    logging.info("Computing number of files to process")
+    if _mapper.mapping_store is not None:
+        _mapper.mapping_store.commit()
 
-    nb_files = 0
+    return shard_id
 
-    for root, dirs, files in os.walk(os.path.abspath(corpus_path)):
-        for filename in files:
-            if re.match("^.*\.txt$", filename):
-                nb_files += 1
 
-    processed = 0
+def _replace_file_star(args):
 
-    logging.info("Replacing placeholders. This can take a long time...")
+    if is_shard(args[0]):
+        return _replace_shard(*args)
 
-    for root, dirs, files in os.walk(os.path.abspath(corpus_path)):
-        for filename in sorted(files):
-            if re.match(".*\.txt", filename):
+    return _replace_file(*args)
 
-                source_file = os.path.join(root, filename)
-                subdir = remove_abs(re.sub(os.path.abspath(corpus_path), "", root))
 
-                target_path = os.path.join(os.path.abspath(output_path), subdir)
-                target_file = os.path.join(target_path, filename)
+def load_subject_map(subject_map_path):
+    """
+    Load the subject of each document from a CSV file with "row_id,subject_id" lines (e.g. exported from
+    mimiciii.noteevents). Lines not starting with a row_id (e.g. headers) are ignored.
+    :param subject_map_path: CSV file path
+    :return: dictionary row_id -> subject_id
+    """
 
-                ensure_dir(target_path)
+    subject_map = dict()
 
-                content = open(source_file, "r", encoding="UTF-8").read()
-                content_modified = ''
+    with open(subject_map_path, "r", encoding="UTF-8") as input_file:
+        for line in input_file:
+            parts = line.rstrip("\n").split(",")
+            if len(parts) >= 2 and parts[0].strip().isdigit():
+                subject_map[int(parts[0])] = parts[1].strip()
+
+    return subject_map
+
+
+def _get_scope_id(scope, document_id, subject_map):
+    """
+    Compute the mapping scope identifier of a document
+    :param scope: mapping scope
+    :param document_id: path relative to the corpus directory (category/NNNN/row_id.txt)
+    :param subject_map: dictionary row_id -> subject_id, used by the subject scope
+    :return: scope identifier
+    """
+
+    if scope == "global":
+        return ""
+
+    if scope == "category":
+        return document_id.split(os.sep)[0]
+
+    if scope == "subject":
+        row_id = os.path.splitext(os.path.basename(document_id))[0]
+        if row_id.isdigit() and int(row_id) in subject_map:
+            return "subject:{}".format(subject_map[int(row_id)])
+
+    # Documents without a known subject get their own scope
+    return "document:{}".format(document_id)
+
+
+def replace_placeholders(corpus_path, output_path, list_path, seed=777, n_jobs=1, list_store_path=None,
+                         weighted_names=False, scope="global", mapping_size=100000, subject_map_path=None,
+                         mapping_store_path=None, resume=False, delta_path=None):
+    """
+    Replace placeholders in a corpus.
+    Results only depend on the seed and on the file paths relative to the corpus directory, not on the number of
+    processes.
+    :param corpus_path: input corpus path (.txt files or .jsonl shards)
+    :param output_path: path where pseudonymized versions will be stored
+    :param list_path: list directory path
+    :param seed: random seed
+    :param n_jobs: number of processes to use
+    :param list_store_path: list store path (default: .lists.bin in the list directory)
+    :param weighted_names: sample census names according to their frequency instead of uniformly
+    :param scope: scope in which a keyed placeholder keeps the same replacement (global, category, subject or
+    document)
+    :param mapping_size: maximum number of placeholder replacements cached by each process
+    :param subject_map_path: CSV file with "row_id,subject_id" lines, required by the subject scope
+    :param mapping_store_path: SQLite file where placeholder replacements are persisted
+    :param resume: skip the files listed in the checkpoint of a previous run
+    :param delta_path: only process the files listed in this delta list (incremental extraction)
+    :return: nothing
+    """
+
+    list_store_path = prepare_list_store(list_path, list_store_path)
+
+    subject_map = dict()
+    if scope == "subject":
+        if subject_map_path is None:
+            raise ValueError("The subject scope requires a subject map")
+        subject_map = load_subject_map(subject_map_path)
+        logging.info("* Subject map: {} documents".format(len(subject_map)))
+
+    if mapping_store_path is not None:
+        # Creating the store before the workers open it
+        MappingStore(mapping_store_path).connection.close()
+
+    mapper_options = {"seed": seed, "scope": scope, "max_size": mapping_size}
+
+    # Files are written atomically and recorded once written. The random generators only depend on the seed, the
+    # document and the placeholder, so a resumed run gives the same results as an uninterrupted one.
+    checkpoint = Checkpoint(os.path.join(os.path.abspath(output_path), ".replace-checkpoint"))
+    if resume:
+        logging.info("* Resuming: {} files already processed".format(len(checkpoint)))
+
+    logging.info("Computing list of files to process")
+
+    entries = [entry for entry in load_manifest(corpus_path) if entry.path.endswith(".txt") or is_shard(entry.path)]
+
+    if delta_path is not None:
+        delta = load_delta_list(delta_path)
+        entries = [entry for entry in entries if entry.path in delta]
+        logging.info("* Delta list: {} files".format(len(entries)))
+
+    # Largest files first for load balancing, except for the category scope which benefits from processing the
+    # documents of a category together
+    if scope != "category":
+        entries = largest_first(entries)
+
+    processing_list = list()
+
+    for entry in entries:
+        if resume and entry.path in checkpoint:
+            continue
+
+        source_file = os.path.join(os.path.abspath(corpus_path), entry.path)
+        target_file = os.path.join(os.path.abspath(output_path), entry.path)
+
+        if is_shard(entry.path):
+            # Scopes of the documents of a shard are computed by the workers, which only get the subjects they need
+            shard_subjects = dict()
+            if scope == "subject":
+                shard_subjects = {row_id: subject_map[row_id] for row_id in load_index(source_file)
+                                  if row_id in subject_map}
+            processing_list.append((source_file, target_file, entry.path, shard_subjects))
+        else:
+            processing_list.append((source_file, target_file, entry.path,
+                                    _get_scope_id(scope, entry.path, subject_map)))
 
-                start = 0
+    for target_dir in sorted({os.path.dirname(target_file) for _, target_file, _, _ in processing_list}):
+        ensure_dir(target_dir)
 
-                for mo in re.finditer("\[\*\*[^\[]*\*\*\]", content):
+    nb_files = len(processing_list)
+    processed = 0
 
-                    replacement = mapper.get_mapping(mo.group(0))
+    logging.info("Replacing placeholders with {} jobs. This can take a long time...".format(n_jobs))
 
-                    content_modified += content[start: mo.start()]
-                    content_modified += replacement
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                                    initargs=(list_store_path, weighted_names, mapping_store_path, mapper_options))
+        results = pool.imap_unordered(_replace_file_star, processing_list, chunksize=64)
+    else:
+        pool = None
+        _init_worker(list_store_path, weighted_names, mapping_store_path, mapper_options)
+        results = map(_replace_file_star, processing_list)
 
-                    start = mo.end()
+    for document_id in results:
+        checkpoint.add(document_id)
 
-                if start < len(content):
-                    content_modified += content[start: len(content)]
+        processed += 1
+        if processed % 1000 == 0 or processed == nb_files:
+            logging.info("Processed: {}/{} ({}%)".format(
+                processed, nb_files, round(float(processed/nb_files) * 100, 2)
+            ))
 
-                with open(target_file, "w", encoding="UTF-8") as output_file:
-                    output_file.write(content_modified)
+    checkpoint.close()
 
-                processed += 1
-                if processed % 1000 == 0 or processed == nb_files:
-                    logging.info("Processed: {}/{} ({}%)".format(
-                        processed, nb_files, round(float(processed/nb_files) * 100, 2)
-                    ))
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     logging.info("Done !")
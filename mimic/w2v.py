@@ -1,46 +1,279 @@
+import json
+import logging
+import mmap
 import os
 import random
-import re
+from array import array
 
 import gensim
 
+from .shards import is_index, is_shard, read_shard
+
+# Number of characters read at once from tokenized files
+READ_SIZE = 1024 * 1024
+
+# Default number of lines held by the shuffle buffer
+DEFAULT_SHUFFLE_BUFFER = 100000
+
+# Prepared corpus: token ids (uint32), offset of each sentence in the token ids (uint64, one more than the number of
+# sentences) and vocabulary ("word<TAB>count" lines, the id of a word being its line number)
+PREPARED_VERSION = 1
+PREPARED_HEADER = "corpus.json"
+TOKENS_FILE = "tokens.bin"
+OFFSETS_FILE = "offsets.bin"
+VOCAB_FILE = "vocab.tsv"
+
+# Number of values buffered before being written to the prepared corpus
+WRITE_BLOCK = 1024 * 1024
+
+# Number of sentences of a prepared corpus decoded at once
+READ_BLOCK = 10000
+
+
+def read_lines(filename, read_size=READ_SIZE):
+    """
+    Stream the non-empty lines of a tokenized file, reading it by fixed-size blocks
+    :param filename: file path (.txt file or .jsonl shard)
+    :param read_size: number of characters read at once
+    :return: iterator over lines (without newline)
+    """
+
+    if is_shard(filename):
+        for _, record_text in read_shard(filename):
+            for line in record_text.split("\n"):
+                if line:
+                    yield line
+        return
+
+    with open(os.path.abspath(filename), "r", encoding="UTF-8") as input_file:
+        remainder = ""
+
+        while True:
+            block = input_file.read(read_size)
+            if not block:
+                break
+
+            lines = (remainder + block).split("\n")
+            remainder = lines.pop()
+
+            for line in lines:
+                if line:
+                    yield line
+
+        if remainder:
+            yield remainder
+
+
+def shuffle_buffer(items, buffer_size, rng=random):
+    """
+    Shuffle a stream with a bounded buffer: each incoming item replaces a random item of the buffer, which is
+    yielded. Items can only move by about buffer_size positions.
+    :param items: iterable
+    :param buffer_size: number of items held in memory (0: no shuffling)
+    :param rng: random generator
+    :return: iterator over the items
+    """
+
+    if buffer_size <= 0:
+        yield from items
+        return
+
+    buffer = list()
+
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+
+        position = int(rng.random() * buffer_size)
+        yield buffer[position]
+        buffer[position] = item
+
+    rng.shuffle(buffer)
+    yield from buffer
+
 
 class FilesIterator:
 
-    def __init__(self, input_directory):
+    def __init__(self, input_directory, buffer_size=DEFAULT_SHUFFLE_BUFFER):
 
         self.input_directory = input_directory
+        self.buffer_size = buffer_size
         self.file_list = list()
 
         for root, dirs, files in os.walk(os.path.abspath(input_directory)):
             for filename in files:
+                if filename.startswith(".") or is_index(filename):
+                    continue
+
                 source_file = os.path.join(root, filename)
                 self.file_list.append(source_file)
 
+    def _lines(self):
+
+        for filename in self.file_list:
+            yield from read_lines(filename)
+
     def __iter__(self):
 
         random.shuffle(self.file_list)
 
-        for filename in self.file_list:
-            with open(os.path.abspath(filename), "r", encoding="UTF-8") as input_file:
-                all_lines = list(input_file)
-                random.shuffle(all_lines)
+        # Lines are streamed in random file order and shuffled across files with a bounded buffer, so that memory does
+        # not depend on the size of the files
+        for line in shuffle_buffer(self._lines(), self.buffer_size):
+            yield line.split(" ")
+
+
+def prepare_corpus(input_directory, output_directory):
+    """
+    Encode a tokenized corpus (one sentence per line, space-separated tokens) into a prepared corpus
+    :param input_directory: tokenized corpus path (CORENLP output)
+    :param output_directory: prepared corpus path
+    :return: nothing
+    """
+
+    word_ids = dict()
+    counts = list()
+    nb_tokens = 0
+    nb_sentences = 0
+
+    file_list = sorted(FilesIterator(input_directory).file_list)
+    logging.info("* Number of files: {}".format(len(file_list)))
+
+    with open(os.path.join(output_directory, TOKENS_FILE), "wb") as tokens_file, \
+            open(os.path.join(output_directory, OFFSETS_FILE), "wb") as offsets_file:
+        tokens = array("I")
+        offsets = array("Q", [0])
+
+        for filename in file_list:
+            for line in read_lines(filename):
+                sentence = line.split(" ")
+
+                for word in sentence:
+                    word_id = word_ids.get(word)
+                    if word_id is None:
+                        word_id = word_ids[word] = len(counts)
+                        counts.append(0)
+
+                    counts[word_id] += 1
+                    tokens.append(word_id)
 
-                for line in all_lines:
-                    if re.match("^$", line):
-                        continue
+                nb_tokens += len(sentence)
+                nb_sentences += 1
+                offsets.append(nb_tokens)
 
-                    yield line.rstrip("\n").split(" ")
+                if len(tokens) >= WRITE_BLOCK:
+                    tokens.tofile(tokens_file)
+                    tokens = array("I")
+                if len(offsets) >= WRITE_BLOCK:
+                    offsets.tofile(offsets_file)
+                    offsets = array("Q")
+
+        tokens.tofile(tokens_file)
+        offsets.tofile(offsets_file)
+
+    with open(os.path.join(output_directory, VOCAB_FILE), "w", encoding="UTF-8") as vocab_file:
+        for word, count in zip(word_ids, counts):
+            vocab_file.write("{}\t{}\n".format(word, count))
+
+    header = {"version": PREPARED_VERSION, "sentences": nb_sentences, "tokens": nb_tokens, "words": len(counts)}
+    with open(os.path.join(output_directory, PREPARED_HEADER), "w", encoding="UTF-8") as header_file:
+        json.dump(header, header_file)
+
+    logging.info("* {:,} sentences, {:,} tokens, {:,} distinct words".format(nb_sentences, nb_tokens, len(counts)))
+
+
+def is_prepared_corpus(corpus_directory):
+
+    return os.path.isfile(os.path.join(corpus_directory, PREPARED_HEADER))
+
+
+def _map_array(file_path, typecode):
+    """
+    Memory-map an array file
+    :param file_path: file path
+    :param typecode: array type code ("I" or "Q")
+    :return: read-only memoryview of the values
+    """
+
+    with open(file_path, "rb") as input_file:
+        if os.fstat(input_file.fileno()).st_size == 0:
+            return memoryview(array(typecode))
+
+        return memoryview(mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+
+class PreparedCorpus:
+    """
+    Sentences of a prepared corpus. Token ids are memory-mapped and turned into words by blocks of sentences, which
+    are shuffled with a bounded buffer.
+    """
+
+    def __init__(self, corpus_directory, buffer_size=DEFAULT_SHUFFLE_BUFFER):
+
+        with open(os.path.join(corpus_directory, PREPARED_HEADER), "r", encoding="UTF-8") as header_file:
+            self.header = json.load(header_file)
+
+        if self.header["version"] != PREPARED_VERSION:
+            raise ValueError("Unsupported prepared corpus version: {}".format(self.header["version"]))
+
+        self.words = list()
+        self.counts = list()
+
+        with open(os.path.join(corpus_directory, VOCAB_FILE), "r", encoding="UTF-8") as vocab_file:
+            for line in vocab_file:
+                word, count = line.rstrip("\n").rsplit("\t", 1)
+                self.words.append(word)
+                self.counts.append(int(count))
+
+        self.tokens = _map_array(os.path.join(corpus_directory, TOKENS_FILE), "I")
+        self.offsets = _map_array(os.path.join(corpus_directory, OFFSETS_FILE), "Q")
+        self.buffer_size = buffer_size
+
+    def __len__(self):
+
+        return self.header["sentences"]
+
+    def get_word_freq(self):
+
+        return dict(zip(self.words, self.counts))
+
+    def _sentences(self):
+
+        get_word = self.words.__getitem__
+
+        for block_start in range(0, len(self), READ_BLOCK):
+            block_end = min(block_start + READ_BLOCK, len(self))
+
+            offsets = self.offsets[block_start:block_end + 1].tolist()
+            words = list(map(get_word, self.tokens[offsets[0]:offsets[-1]].tolist()))
+
+            for start, end in zip(offsets, offsets[1:]):
+                yield words[start - offsets[0]:end - offsets[0]]
+
+    def __iter__(self):
+
+        return shuffle_buffer(self._sentences(), self.buffer_size)
 
 
 def build_model(input_directory, target_dir, model_prefix, size=100, window=5, min_count=5, sg=0, n_jobs=1,
-                iterations=5, neg_sample=5, sample=0.001, alpha=0.025):
+                iterations=5, neg_sample=5, sample=0.001, alpha=0.025, shuffle_buffer_size=DEFAULT_SHUFFLE_BUFFER):
 
     target_model_name = os.path.join(target_dir, '{}.pkl'.format(model_prefix))
 
-    sentences = FilesIterator(input_directory)
+    if is_prepared_corpus(input_directory):
+        # Vocabulary built from the stored counts, without a scanning pass
+        sentences = PreparedCorpus(input_directory, buffer_size=shuffle_buffer_size)
+
+        model = gensim.models.Word2Vec(sg=sg, workers=n_jobs, iter=iterations, window=window, size=size,
+                                       min_count=min_count, negative=neg_sample, sample=sample, alpha=alpha)
+        model.build_vocab_from_freq(sentences.get_word_freq(), corpus_count=len(sentences))
+        model.train(sentences, total_examples=len(sentences), epochs=iterations)
+
+    else:
+        sentences = FilesIterator(input_directory, buffer_size=shuffle_buffer_size)
 
-    model = gensim.models.Word2Vec(sentences, sg=sg, workers=n_jobs, iter=iterations, window=window, size=size,
-                                   min_count=min_count, negative=neg_sample, sample=sample, alpha=alpha)
+        model = gensim.models.Word2Vec(sentences, sg=sg, workers=n_jobs, iter=iterations, window=window, size=size,
+                                       min_count=min_count, negative=neg_sample, sample=sample, alpha=alpha)
 
     model.save(target_model_name)